@@ -0,0 +1,28 @@
+import click
+import frappe
+from frappe.commands import pass_context
+from frappe.exceptions import SiteNotSpecifiedError
+
+
+@click.command("rebuild-whatsapp-production-summary")
+@click.option("--year", type=int, help="Only rebuild this year")
+@pass_context
+def rebuild_whatsapp_production_summary(context, year=None):
+    """Rebuild the monthly production summary read by the WhatsApp bot."""
+    from frappe_whatsapp.utils.production_summary import rebuild_production_summary
+
+    for site in context.sites:
+        frappe.init(site=site)
+        frappe.connect()
+        try:
+            rows = rebuild_production_summary(year=year)
+            frappe.db.commit()
+            click.echo(f"{site}: {rows} summary rows rebuilt")
+        finally:
+            frappe.destroy()
+
+    if not context.sites:
+        raise SiteNotSpecifiedError
+
+
+commands = [rebuild_whatsapp_production_summary]
@@ -3,44 +3,43 @@
 import json
 
 import frappe
-from frappe.integrations.utils import make_post_request
 from frappe.model.document import Document
 
+from frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_settings.whatsapp_settings import (
+    get_whatsapp_settings,
+)
+from frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_templates.whatsapp_templates import (
+    get_template,
+)
+from frappe_whatsapp.utils.graph_api import GraphAPIError, get_client
+from frappe_whatsapp.utils.outbound_queue import enqueue_drain
+
 
 class WhatsAppMessage(Document):
     """Send whats app messages."""
 
     def before_insert(self):
         """Send message."""
-        if self.type == "Outgoing" and self.message_type != "Template":
-            if self.attach and not self.attach.startswith("http"):
-                link = frappe.utils.get_url() + "/" + self.attach
-            else:
-                link = self.attach
-
-            data = {
-                "messaging_product": "whatsapp",
-                "to": self.format_number(self.to),
-                "type": self.content_type,
-            }
-            if self.is_reply and self.reply_to_message_id:
-                data["context"] = {"message_id": self.reply_to_message_id}
-            if self.content_type in ["document", "image", "video"]:
-                data[self.content_type.lower()] = {
-                    "link": link,
-                    "caption": self.message,
-                }
-            elif self.content_type == "reaction":
-                data["reaction"] = {
-                    "message_id": self.reply_to_message_id,
-                    "emoji": self.message,
-                }
-            elif self.content_type == "text":
-                data["text"] = {"preview_url": False, "body": self.message}
+        if self.type == "Outgoing" and self.status == "Queued" and self.payload:
+            enqueue_drain()
+            return
 
-            elif self.content_type == "audio":
-                data["text"] = {"link": link}
+        if (
+            self.type == "Outgoing"
+            and not self.message_id
+            and get_whatsapp_settings().queue_outgoing_messages
+        ):
+            if self.message_type == "Template":
+                data = self.get_template_payload()
+            else:
+                data = self.get_message_payload()
+            self.payload = json.dumps(data)
+            self.status = "Queued"
+            enqueue_drain()
+            return
 
+        if self.type == "Outgoing" and self.message_type != "Template":
+            data = self.get_message_payload()
             try:
                 self.notify(data)
                 self.status = "Success"
@@ -54,9 +53,48 @@ class WhatsAppMessage(Document):
         ):
             self.send_template()
 
+    def get_message_payload(self):
+        """Graph API payload of a manual message."""
+        if self.attach and not self.attach.startswith("http"):
+            link = frappe.utils.get_url() + "/" + self.attach
+        else:
+            link = self.attach
+
+        data = {
+            "messaging_product": "whatsapp",
+            "to": self.format_number(self.to),
+            "type": self.content_type,
+        }
+        if self.is_reply and self.reply_to_message_id:
+            data["context"] = {"message_id": self.reply_to_message_id}
+        if self.content_type in ["document", "image", "video"]:
+            data[self.content_type.lower()] = {
+                "link": link,
+                "caption": self.message,
+            }
+        elif self.content_type == "reaction":
+            data["reaction"] = {
+                "message_id": self.reply_to_message_id,
+                "emoji": self.message,
+            }
+        elif self.content_type == "text":
+            data["text"] = {"preview_url": False, "body": self.message}
+
+        elif self.content_type == "audio":
+            data["text"] = {"link": link}
+
+        return data
+
     def send_template(self):
         """Send template."""
-        template = frappe.get_doc("WhatsApp Templates", self.template)
+        self.notify(self.get_template_payload())
+
+    def get_template_payload(self):
+        """Graph API payload of a template message."""
+        template = get_template(self.template)
+        if not template:
+            frappe.throw(f"WhatsApp Template {self.template} not found")
+
         data = {
             "messaging_product": "whatsapp",
             "to": self.format_number(self.to),
@@ -114,40 +152,24 @@ class WhatsAppMessage(Document):
                 }
             )
 
-        self.notify(data)
+        return data
 
     def notify(self, data):
         """Notify."""
-        settings = frappe.get_doc(
-            "WhatsApp Settings",
-            "WhatsApp Settings",
-        )
-        token = settings.get_password("token")
-
-        headers = {
-            "authorization": f"Bearer {token}",
-            "content-type": "application/json",
-        }
         try:
-            response = make_post_request(
-                f"{settings.url}/{settings.version}/{settings.phone_id}/messages",
-                headers=headers,
-                data=json.dumps(data),
-            )
+            response = get_client().send_message(data)
             self.message_id = response["messages"][0]["id"]
 
-        except Exception as e:
-            res = frappe.flags.integration_request.json()["error"]
-            error_message = res.get("Error", res.get("message"))
+        except GraphAPIError as e:
             frappe.get_doc(
                 {
                     "doctype": "WhatsApp Notification Log",
                     "template": "Text Message",
-                    "meta_data": frappe.flags.integration_request.json(),
+                    "meta_data": e.data,
                 }
             ).insert(ignore_permissions=True)
 
-            frappe.throw(msg=error_message, title=res.get("error_user_title", "Error"))
+            frappe.throw(msg=e.message, title=e.title or "Error")
 
     def format_number(self, number):
         """Format number."""
@@ -159,6 +181,35 @@ class WhatsAppMessage(Document):
 
 def on_doctype_update():
     frappe.db.add_index("WhatsApp Message", ["reference_doctype", "reference_name"])
+    # webhooks look messages up by wamid
+    frappe.db.add_index("WhatsApp Message", ["message_id"])
+    frappe.db.add_index("WhatsApp Message", ["conversation_id"])
+    frappe.db.add_index("WhatsApp Message", ["`from`", "creation"], "from_creation_index")
+    frappe.db.add_index("WhatsApp Message", ["`to`", "creation"], "to_creation_index")
+    # outbound queue drain
+    frappe.db.add_index("WhatsApp Message", ["status", "`type`"], "status_type_index")
+
+
+def get_message_by_wamid(wamid, fieldname="name", as_dict=False):
+    """Get WhatsApp Message by Meta message id (wamid)."""
+    if not wamid:
+        return None
+
+    return frappe.db.get_value(
+        "WhatsApp Message", {"message_id": wamid}, fieldname, as_dict=as_dict
+    )
+
+
+def get_messages_by_wamid(wamids, fields=("name", "message_id")):
+    """Get WhatsApp Messages for a list of wamids with one query."""
+    if not wamids:
+        return []
+
+    return frappe.get_all(
+        "WhatsApp Message",
+        filters={"message_id": ("in", list(wamids))},
+        fields=list(fields),
+    )
 
 
 @frappe.whitelist()
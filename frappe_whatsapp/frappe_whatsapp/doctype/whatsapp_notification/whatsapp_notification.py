@@ -1,20 +1,38 @@
 """Notification."""
 
-import json
-
 import frappe
 from frappe.desk.form.utils import get_pdf_link
-from frappe.integrations.utils import make_post_request
 from frappe.model.document import Document
 from frappe.utils import add_to_date, datetime, nowdate
 from frappe.utils.safe_exec import get_safe_globals, safe_exec
 
+from frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_settings.whatsapp_settings import (
+    get_whatsapp_settings,
+)
+from frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_templates.whatsapp_templates import (
+    get_template,
+)
+from frappe_whatsapp.utils import IGNORED_DOCTYPES, clear_notifications_map
+from frappe_whatsapp.utils.conditions import evaluate_condition
+from frappe_whatsapp.utils.bulk_send import (
+    SendResult,
+    save_send_results,
+    send_and_save,
+)
+from frappe_whatsapp.utils.graph_api import get_client
+from frappe_whatsapp.utils.outbound_queue import queue_message
+
 
 class WhatsAppNotification(Document):
     """Notification."""
 
     def validate(self):
         """Validate."""
+        if self.reference_doctype in IGNORED_DOCTYPES:
+            frappe.throw(
+                f"WhatsApp notifications can not be set for {self.reference_doctype}"
+            )
+
         if self.notification_type == "DocType Event":
             fields = frappe.get_doc("DocType", self.reference_doctype).fields
             fields += frappe.get_all(
@@ -33,26 +51,24 @@ class WhatsAppNotification(Document):
     def send_scheduled_message(self) -> dict:
         """Specific to API endpoint Server Scripts."""
         safe_exec(self.condition, get_safe_globals(), dict(doc=self))
-        language_code = frappe.db.get_value(
-            "WhatsApp Templates", self.template, fieldname="language_code"
-        )
-        template_actual_name = frappe.db.get_value(
-            "WhatsApp Templates", self.template, fieldname="actual_name"
-        )
-        if language_code:
+        template = get_template(self.template)
+        if template and template.language_code:
+            payloads = []
             for contact in self._contact_list:
                 data = {
                     "messaging_product": "whatsapp",
                     "to": self.format_number(contact),
                     "type": "template",
                     "template": {
-                        "name": template_actual_name,
-                        "language": {"code": language_code},
+                        "name": template.actual_name,
+                        "language": {"code": template.language_code},
                         "components": [],
                     },
                 }
-                self.content_type = template.get("header_type", "text").lower()
-                self.notify(data)
+                payloads.append(data)
+
+            self.content_type = (template.header_type or "text").lower()
+            self.notify_bulk(payloads)
         # return _globals.frappe.flags
 
     def send_template_message(self, doc: Document):
@@ -60,17 +76,13 @@ class WhatsAppNotification(Document):
         if self.disabled:
             return
 
+        # check if condition satisfies, before serializing the doc
+        if not evaluate_condition(self, doc):
+            return
+
         doc_data = doc.as_dict()
-        if self.condition:
-            # check if condition satisfies
-            if not frappe.safe_eval(
-                self.condition, get_safe_globals(), dict(doc=doc_data)
-            ):
-                return
-
-        template = frappe.db.get_value(
-            "WhatsApp Templates", self.template, fieldname="*"
-        )
+
+        template = get_template(self.template)
 
         if template:
             data = {
@@ -169,69 +181,65 @@ class WhatsAppNotification(Document):
 
     def notify(self, data):
         """Notify."""
-        settings = frappe.get_doc(
-            "WhatsApp Settings",
-            "WhatsApp Settings",
-        )
-        token = settings.get_password("token")
+        if get_whatsapp_settings().queue_outgoing_messages:
+            queue_message(
+                data,
+                message=str(data["template"]),
+                message_type="Template",
+                content_type=self.get("content_type") or "text",
+            )
+            return
 
-        headers = {
-            "authorization": f"Bearer {token}",
-            "content-type": "application/json",
-        }
         try:
-            success = False
-            response = make_post_request(
-                f"{settings.url}/{settings.version}/{settings.phone_id}/messages",
-                headers=headers,
-                data=json.dumps(data),
+            result = SendResult(data, get_client().send_message(data), None)
+            frappe.msgprint("WhatsApp Message Triggered", indicator="green", alert=True)
+
+        except Exception as e:
+            result = SendResult(data, None, e)
+            frappe.msgprint(
+                f"Failed to trigger whatsapp message: {str(e)}",
+                indicator="red",
+                alert=True,
             )
 
-            if not self.get("content_type"):
-                self.content_type = "text"
-
-            frappe.get_doc(
-                {
-                    "doctype": "WhatsApp Message",
-                    "type": "Outgoing",
-                    "message": str(data["template"]),
-                    "to": data["to"],
-                    "message_type": "Template",
-                    "message_id": response["messages"][0]["id"],
-                    "content_type": self.content_type,
-                }
-            ).save(ignore_permissions=True)
+        save_send_results(
+            [result], template=self.template, content_type=self.get("content_type")
+        )
 
-            frappe.msgprint("WhatsApp Message Triggered", indicator="green", alert=True)
-            success = True
+    def notify_bulk(self, payloads):
+        """Send to many recipients concurrently."""
+        if not payloads:
+            return
 
-        except Exception as e:
-            error_message = str(e)
-            if frappe.flags.integration_request:
-                response = frappe.flags.integration_request.json()["error"]
-                error_message = response.get("Error", response.get("message"))
+        if len(payloads) == 1 or get_whatsapp_settings().queue_outgoing_messages:
+            for data in payloads:
+                self.notify(data)
+            return
 
+        results = send_and_save(
+            payloads, template=self.template, content_type=self.get("content_type")
+        )
+        failed = [result for result in results if result.error]
+        if failed:
             frappe.msgprint(
-                f"Failed to trigger whatsapp message: {error_message}",
+                f"Failed to trigger whatsapp message for {len(failed)} of {len(results)} recipients: {failed[0].error.message}",
                 indicator="red",
                 alert=True,
             )
-        finally:
-            if not success:
-                meta = {"error": error_message}
-            else:
-                meta = frappe.flags.integration_request.json()
-            frappe.get_doc(
-                {
-                    "doctype": "WhatsApp Notification Log",
-                    "template": self.template,
-                    "meta_data": meta,
-                }
-            ).insert(ignore_permissions=True)
+        else:
+            frappe.msgprint("WhatsApp Message Triggered", indicator="green", alert=True)
+
+    def on_update(self):
+        """Rebuild doc event mapping."""
+        clear_notifications_map()
+
+    def after_rename(self, old, new, merge=False):
+        """Rebuild doc event mapping."""
+        clear_notifications_map()
 
     def on_trash(self):
         """On delete remove from schedule."""
-        frappe.cache().delete_value("whatsapp_notification_map")
+        clear_notifications_map()
 
     def format_number(self, number):
         """Format number."""
@@ -0,0 +1,20 @@
+# Copyright (c) 2026, Shridhar Patil and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+
+class WhatsAppProductionSummary(Document):
+	pass
+
+
+def on_doctype_update():
+	frappe.db.add_index(
+		"WhatsApp Production Summary", ["site_name", "year", "month"], "site_year_month_index"
+	)
+	# upserts of incremental updates rely on it
+	frappe.db.add_unique(
+		"WhatsApp Production Summary",
+		["site_name", "mining_item_code", "year", "month"],
+		"site_item_year_month_unique",
+	)
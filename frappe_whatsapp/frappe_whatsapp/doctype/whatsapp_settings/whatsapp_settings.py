@@ -1,8 +1,44 @@
 # Copyright (c) 2022, Shridhar Patil and contributors
 # For license information, please see license.txt
 
-# import frappe
+import frappe
 from frappe.model.document import Document
 
+from frappe_whatsapp.utils.cache import clear_cached_value, get_cached_value
+
+SETTINGS_CACHE_KEY = "whatsapp_settings"
+
 class WhatsAppSettings(Document):
-	pass
+	def on_update(self):
+		clear_cached_value(SETTINGS_CACHE_KEY)
+
+
+def get_whatsapp_settings():
+	"""Resolved settings, cached per site and process.
+
+	The decrypted token is only kept in process memory, never in Redis.
+	"""
+	return get_cached_value(SETTINGS_CACHE_KEY, load_whatsapp_settings, shared=False)
+
+
+def load_whatsapp_settings():
+	settings = frappe.get_doc("WhatsApp Settings", "WhatsApp Settings")
+	return frappe._dict(
+		{
+			"enabled": settings.enabled,
+			"url": settings.url,
+			"version": settings.version,
+			"phone_id": settings.phone_id,
+			"business_id": settings.business_id,
+			"app_id": settings.app_id,
+			"token": settings.get_password("token", raise_exception=False),
+			"webhook_verify_token": settings.webhook_verify_token,
+			"process_webhook_in_background": settings.process_webhook_in_background,
+			"webhook_queue": settings.webhook_queue,
+			"queue_outgoing_messages": settings.queue_outgoing_messages,
+			"messages_per_second": settings.messages_per_second,
+			"bulk_send_concurrency": settings.bulk_send_concurrency,
+			"sync_templates": settings.sync_templates,
+			"max_media_size": settings.max_media_size,
+		}
+	)
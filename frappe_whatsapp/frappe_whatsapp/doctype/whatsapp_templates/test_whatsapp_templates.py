@@ -1,9 +1,56 @@
 # Copyright (c) 2022, Shridhar Patil and Contributors
 # See license.txt
 
-# import frappe
-from frappe.tests import UnitTestCase
+from unittest.mock import patch
+
+import frappe
+from frappe.tests import IntegrationTestCase, UnitTestCase
+
+from frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_templates.whatsapp_templates import (
+	get_unique_template_name,
+	sync_templates,
+)
+
+TEMPLATES_MODULE = "frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_templates.whatsapp_templates"
+
+
+def get_remote_template(language, template_id):
+	return {
+		"name": "_test_sync_greeting",
+		"language": language,
+		"status": "APPROVED",
+		"category": "UTILITY",
+		"id": template_id,
+		"components": [{"type": "BODY", "text": "Hello {{1}}", "example": {"body_text": [["Ann"]]}}],
+	}
 
 
 class TestWhatsAppTemplates(UnitTestCase):
-	pass
+	def test_unique_template_name(self):
+		taken = {"greeting", "greeting-es"}
+		self.assertEqual(get_unique_template_name("welcome", "en", taken), "welcome")
+		self.assertEqual(get_unique_template_name("greeting", "de", taken), "greeting-de")
+		self.assertEqual(get_unique_template_name("greeting", "es", taken), "greeting-es-2")
+
+
+class TestWhatsAppTemplatesSync(IntegrationTestCase):
+	def test_sync_template_in_two_languages(self):
+		remote = [get_remote_template("en", "101"), get_remote_template("es", "102")]
+		with (
+			patch(f"{TEMPLATES_MODULE}.get_client"),
+			patch(f"{TEMPLATES_MODULE}.get_remote_templates", return_value=remote),
+		):
+			self.assertEqual(sync_templates()["inserted"], 2)
+			# a second sync matches both rows by name and language
+			self.assertEqual(sync_templates()["unchanged"], 2)
+
+		rows = frappe.get_all(
+			"WhatsApp Templates",
+			filters={"actual_name": "_test_sync_greeting"},
+			fields=["template_name", "language_code"],
+			order_by="language_code",
+		)
+		self.assertEqual(
+			[(row.template_name, row.language_code) for row in rows],
+			[("_test_sync_greeting", "en"), ("_test_sync_greeting-es", "es")],
+		)
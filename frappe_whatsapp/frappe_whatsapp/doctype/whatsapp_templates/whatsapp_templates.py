@@ -2,14 +2,57 @@
 
 # Copyright (c) 2022, Shridhar Patil and contributors
 # For license information, please see license.txt
+import hashlib
 import json
 import os
 
 import frappe
 import magic
 from frappe.desk.form.utils import get_pdf_link
-from frappe.integrations.utils import make_post_request, make_request
 from frappe.model.document import Document
+from frappe.model.naming import set_new_name
+from frappe.utils import cint, now, time_diff_in_seconds
+
+from frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_settings.whatsapp_settings import (
+    get_whatsapp_settings,
+)
+from frappe_whatsapp.utils.cache import clear_cached_value, get_cached_value
+from frappe_whatsapp.utils.graph_api import GraphAPIError, get_client
+
+TEMPLATE_CACHE_KEY = "whatsapp_templates"
+# what send paths need to build a template payload
+TEMPLATE_FIELDS = (
+    "name",
+    "template_name",
+    "actual_name",
+    "language_code",
+    "status",
+    "id",
+    "header_type",
+    "sample",
+    "sample_values",
+    "field_names",
+)
+# fields fetch() takes from Meta
+SYNCED_FIELDS = (
+    "status",
+    "language_code",
+    "category",
+    "id",
+    "header_type",
+    "header",
+    "footer",
+    "template",
+    "sample_values",
+)
+FETCH_PAGE_SIZE = 100
+MIN_SYNC_INTERVAL = 30 * 60
+
+UPLOAD_HANDLE_KEY = "whatsapp_template_upload"
+MIME_TYPE_KEY = "whatsapp_template_mime"
+UPLOAD_HANDLE_EXPIRY = 24 * 60 * 60
+UPLOAD_ATTEMPTS = 3
+FILE_CHUNK_SIZE = 1024 * 1024
 
 
 class WhatsAppTemplates(Document):
@@ -20,47 +63,93 @@ class WhatsAppTemplates(Document):
             lang_code = frappe.db.get_value("Language", self.language) or "en"
             self.language_code = lang_code.replace("-", "_")
 
-        if self.header_type in ["IMAGE", "DOCUMENT"] and self.sample:
-            self.get_session_id()
-            self.get_media_id()
+        # only talk to Meta when what it knows of the template changes
+        fingerprint = self.get_fingerprint()
+        if self.is_new() or fingerprint != self.fingerprint:
+            if self.has_media_header():
+                self.upload_sample()
 
-        if not self.is_new():
-            self.update_template()
+            if not self.is_new():
+                self.update_template()
 
-    def get_session_id(self):
-        """Upload media."""
-        self.get_settings()
+            self.fingerprint = fingerprint
+
+    def has_media_header(self):
+        return self.header_type in ["IMAGE", "DOCUMENT"] and self.sample
+
+    def get_fingerprint(self):
+        """Hash of the components sent to Meta, with the sample file's hash
+        in place of its upload handle."""
+        self._file_hash = None
+        if self.has_media_header():
+            # the file is only read again when another sample is attached
+            if not self.sample_hash or self.has_value_changed("sample"):
+                self.sample_hash = get_file_hash(self.get_absolute_path(self.sample))
+            self._file_hash = self.sample_hash
+
+        components = self.get_components(header_handle=self._file_hash or "")
+        return get_content_hash(components)
+
+    def upload_sample(self):
+        """Upload the header sample, once per file content.
+
+        The handle Meta returns is cached by the file's SHA-256, so saving
+        a template again with the same sample does not upload it again.
+        """
         file_path = self.get_absolute_path(self.sample)
-        mime = magic.Magic(mime=True)
-        file_type = mime.from_file(file_path)
+        cache = frappe.cache()
+        self._media_id = cache.get_value(f"{UPLOAD_HANDLE_KEY}:{self._file_hash}")
+        if self._media_id:
+            return
+
+        self.get_session_id(file_path)
+        self.get_media_id(file_path)
+        cache.set_value(
+            f"{UPLOAD_HANDLE_KEY}:{self._file_hash}",
+            self._media_id,
+            expires_in_sec=UPLOAD_HANDLE_EXPIRY,
+        )
 
+    def get_session_id(self, file_path):
+        """Upload media."""
+        self.get_settings()
         payload = {
             "file_length": os.path.getsize(file_path),
-            "file_type": file_type,
+            "file_type": get_mime_type(file_path, self._file_hash),
             "messaging_product": "whatsapp",
         }
 
-        response = make_post_request(
-            f"{self._url}/{self._version}/{self._app_id}/uploads",
-            headers=self._headers,
-            data=json.loads(json.dumps(payload)),
-        )
+        response = self._client.post(f"{self._client.app_id}/uploads", params=payload)
         self._session_id = response["id"]
 
-    def get_media_id(self):
-        self.get_settings()
+    def get_media_id(self, file_path):
+        """Stream the file to the upload session.
 
-        headers = {"authorization": f"OAuth {self._token}"}
-        file_name = self.get_absolute_path(self.sample)
-        with open(file_name, mode="rb") as file:  # b is important -> binary
-            file_content = file.read()
+        The body is read from disk in small blocks. If the connection
+        drops, the session is asked for the offset it has received and
+        the upload resumes from there.
+        """
+        self.get_settings()
 
-        payload = file_content
-        response = make_post_request(
-            f"{self._url}/{self._version}/{self._session_id}",
-            headers=headers,
-            data=payload,
-        )
+        offset = 0
+        for attempt in range(1, UPLOAD_ATTEMPTS + 1):
+            try:
+                with open(file_path, mode="rb") as file:  # b is important -> binary
+                    file.seek(offset)
+                    response = self._client.post(
+                        self._session_id,
+                        data=file,
+                        headers={"file_offset": str(offset)},
+                        auth_scheme="OAuth",
+                    )
+                break
+            except GraphAPIError as e:
+                # errors Meta answered with are final, only resume lost transfers
+                if attempt == UPLOAD_ATTEMPTS or (e.status_code or 500) < 500:
+                    raise
+
+                session = self._client.get(self._session_id, auth_scheme="OAuth")
+                offset = cint(session.get("file_offset"))
 
         self._media_id = response["h"]
 
@@ -80,64 +169,29 @@ class WhatsAppTemplates(Document):
             "name": self.actual_name,
             "language": self.language_code,
             "category": self.category,
-            "components": [],
-        }
-
-        body = {
-            "type": "BODY",
-            "text": self.template,
+            "components": self.get_components(),
         }
-        if self.sample_values:
-            body.update({"example": {"body_text": [self.sample_values.split(",")]}})
-
-        data["components"].append(body)
-        if self.header_type:
-            data["components"].append(self.get_header())
-
-        # add footer
-        if self.footer:
-            data["components"].append({"type": "FOOTER", "text": self.footer})
 
         try:
-            response = make_post_request(
-                f"{self._url}/{self._version}/{self._business_id}/message_templates",
-                headers=self._headers,
-                data=json.dumps(data),
+            response = self._client.post(
+                f"{self._client.business_id}/message_templates", json=data
             )
             self.id = response["id"]
             self.status = response["status"]
             self.db_update()
-        except Exception as e:
-            res = frappe.flags.integration_request.json()["error"]
-            error_message = res.get("error_user_msg", res.get("message"))
+        except GraphAPIError as e:
             frappe.throw(
-                msg=error_message,
-                title=res.get("error_user_title", "Error"),
+                msg=e.user_message or e.message,
+                title=e.title or "Error",
             )
 
     def update_template(self):
         """Update template to meta."""
         self.get_settings()
-        data = {"components": []}
-
-        body = {
-            "type": "BODY",
-            "text": self.template,
-        }
-        if self.sample_values:
-            body.update({"example": {"body_text": [self.sample_values.split(",")]}})
-        data["components"].append(body)
-        if self.header_type:
-            data["components"].append(self.get_header())
-        if self.footer:
-            data["components"].append({"type": "FOOTER", "text": self.footer})
+        data = {"components": self.get_components()}
         try:
             # post template to meta for update
-            make_post_request(
-                f"{self._url}/{self._version}/{self.id}",
-                headers=self._headers,
-                data=json.dumps(data),
-            )
+            self._client.post(self.id, json=data)
         except Exception as e:
             raise e
             # res = frappe.flags.integration_request.json()['error']
@@ -146,38 +200,51 @@ class WhatsAppTemplates(Document):
             #     title=res.get("error_user_title", "Error"),
             # )
 
+    def on_update(self):
+        clear_template_cache()
+
     def get_settings(self):
         """Get whatsapp settings."""
-        settings = frappe.get_doc("WhatsApp Settings", "WhatsApp Settings")
-        self._token = settings.get_password("token")
-        self._url = settings.url
-        self._version = settings.version
-        self._business_id = settings.business_id
-        self._app_id = settings.app_id
-
-        self._headers = {
-            "authorization": f"Bearer {self._token}",
-            "content-type": "application/json",
-        }
+        self._client = get_client()
 
     def on_trash(self):
+        clear_template_cache()
         self.get_settings()
-        url = f"{self._url}/{self._version}/{self._business_id}/message_templates?name={self.actual_name}"
         try:
-            make_request("DELETE", url, headers=self._headers)
-        except Exception:
-            res = frappe.flags.integration_request.json()["error"]
-            if res.get("error_user_title") == "Message Template Not Found":
-                frappe.msgprint(
-                    "Deleted locally", res.get("error_user_title", "Error"), alert=True
-                )
+            self._client.delete(
+                f"{self._client.business_id}/message_templates",
+                params={"name": self.actual_name},
+            )
+        except GraphAPIError as e:
+            if e.title == "Message Template Not Found":
+                frappe.msgprint("Deleted locally", e.title, alert=True)
             else:
                 frappe.throw(
-                    msg=res.get("error_user_msg"),
-                    title=res.get("error_user_title", "Error"),
+                    msg=e.user_message,
+                    title=e.title or "Error",
                 )
 
-    def get_header(self):
+    def get_components(self, header_handle=None):
+        """Template components as sent to Meta."""
+        components = []
+        body = {
+            "type": "BODY",
+            "text": self.template,
+        }
+        if self.sample_values:
+            body.update({"example": {"body_text": [self.sample_values.split(",")]}})
+
+        components.append(body)
+        if self.header_type:
+            components.append(self.get_header(header_handle))
+
+        # add footer
+        if self.footer:
+            components.append({"type": "FOOTER", "text": self.footer})
+
+        return components
+
+    def get_header(self, header_handle=None):
         """Get header format."""
         header = {"type": "header", "format": self.header_type}
         if self.header_type == "TEXT":
@@ -187,91 +254,280 @@ class WhatsAppTemplates(Document):
                 header.update({"example": {"header_text": samples}})
         else:
             pdf_link = ""
-            if not self.sample:
+            # not when fingerprinting (handle given), it creates a share key
+            if not self.sample and header_handle is None:
                 key = frappe.get_doc(self.doctype, self.name).get_document_share_key()
                 link = get_pdf_link(self.doctype, self.name)
                 pdf_link = f"{frappe.utils.get_url()}{link}&key={key}"
-            header.update({"example": {"header_handle": [self._media_id]}})
+            if header_handle is None:
+                header_handle = getattr(self, "_media_id", None)
+            header.update({"example": {"header_handle": [header_handle]}})
 
         return header
 
 
-@frappe.whitelist()
-def fetch():
-    """Fetch templates from meta."""
+def get_file_hash(file_path):
+    sha256 = hashlib.sha256()
+    with open(file_path, mode="rb") as file:
+        for chunk in iter(lambda: file.read(FILE_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+
+    return sha256.hexdigest()
+
+
+def get_mime_type(file_path, file_hash):
+    """MIME type of the file, detected once per file content."""
+    key = f"{MIME_TYPE_KEY}:{file_hash}"
+    mime_type = frappe.cache().get_value(key)
+    if not mime_type:
+        mime_type = magic.Magic(mime=True).from_file(file_path)
+        frappe.cache().set_value(key, mime_type, expires_in_sec=UPLOAD_HANDLE_EXPIRY)
 
-    # get credentials
-    settings = frappe.get_doc("WhatsApp Settings", "WhatsApp Settings")
-    token = settings.get_password("token")
-    url = settings.url
-    version = settings.version
-    business_id = settings.business_id
+    return mime_type
 
-    headers = {"authorization": f"Bearer {token}", "content-type": "application/json"}
 
+def get_template(name):
+    """Resolved template metadata, cached until any template changes."""
+    if not name:
+        return None
+
+    return get_cached_value(TEMPLATE_CACHE_KEY, load_templates).get(name)
+
+
+def load_templates():
+    return {
+        template.name: template
+        for template in frappe.get_all(
+            "WhatsApp Templates", fields=list(TEMPLATE_FIELDS)
+        )
+    }
+
+
+def clear_template_cache():
+    clear_cached_value(TEMPLATE_CACHE_KEY)
+
+
+@frappe.whitelist()
+def fetch():
+    """Fetch templates from meta."""
     try:
-        response = make_request(
-            "GET",
-            f"{url}/{version}/{business_id}/message_templates",
-            headers=headers,
+        counts = sync_templates()
+    except GraphAPIError as e:
+        frappe.throw(
+            msg=e.user_message or e.message,
+            title=e.title or "Error",
         )
 
-        for template in response["data"]:
-            # set flag to insert or update
-            flags = 1
-            if frappe.db.exists(
-                "WhatsApp Templates", {"actual_name": template["name"]}
-            ):
-                doc = frappe.get_doc(
-                    "WhatsApp Templates", {"actual_name": template["name"]}
+    return (
+        "Successfully fetched templates from meta: {inserted} inserted, "
+        "{updated} updated, {unchanged} unchanged".format(**counts)
+    )
+
+
+def sync_templates():
+    """Sync all message templates of the business account from Meta.
+
+    Every page is read before anything is written. Changes are diffed
+    against one preloaded map keyed by actual name and language and
+    applied with bulk statements, so a sync is a single transaction and a
+    failed sync writes nothing.
+    """
+    client = get_client()
+    remote = get_remote_templates(client)
+
+    existing = {
+        (template.actual_name, template.language_code): template
+        for template in frappe.get_all(
+            "WhatsApp Templates",
+            fields=[
+                "name",
+                "template_name",
+                "actual_name",
+                "content_hash",
+                "fingerprint",
+                "sample",
+                "sample_hash",
+                *SYNCED_FIELDS,
+            ],
+        )
+    }
+
+    # template_name is unique, other languages of a template need their own
+    taken_names = {template.template_name for template in existing.values()}
+
+    inserts, updates, updated, unchanged = [], {}, 0, 0
+    for template in remote:
+        values = get_template_values(template)
+        values["content_hash"] = get_content_hash(values)
+        current = existing.get((template["name"], template["language"]))
+        if not current:
+            values["fingerprint"] = get_template_fingerprint(values)
+            template_name = get_unique_template_name(
+                template["name"], template["language"], taken_names
+            )
+            inserts.append((template_name, template["name"], values))
+            continue
+
+        if current.content_hash == values["content_hash"] and current.fingerprint:
+            unchanged += 1
+            continue
+
+        changed = {
+            field: value
+            for field, value in values.items()
+            if (current.get(field) or None) != (value or None)
+        }
+        # what Meta has now, so the next save does not push it back
+        fingerprint = get_template_fingerprint({**current, **values})
+        if fingerprint != current.fingerprint:
+            changed["fingerprint"] = fingerprint
+
+        updates[current.name] = changed
+        if set(changed) - {"content_hash", "fingerprint"}:
+            updated += 1
+        else:
+            # only the hashes were missing, e.g. first sync after upgrade
+            unchanged += 1
+
+    # like db_insert/db_update before, sync does not run document hooks
+    insert_templates(inserts)
+    if updates:
+        frappe.db.bulk_update("WhatsApp Templates", updates)
+
+    frappe.db.set_single_value(
+        "WhatsApp Settings", "templates_synced_at", now(), update_modified=False
+    )
+    clear_template_cache()
+    return {"inserted": len(inserts), "updated": updated, "unchanged": unchanged}
+
+
+def get_remote_templates(client, params=None):
+    """All templates from Meta, following the `paging.next` cursors."""
+    templates = []
+    response = client.get(
+        f"{client.business_id}/message_templates",
+        params={"limit": FETCH_PAGE_SIZE, **(params or {})},
+    )
+    while True:
+        templates.extend(response.get("data") or [])
+        next_page = (response.get("paging") or {}).get("next")
+        if not next_page:
+            return templates
+
+        # the next url carries the cursor and the original params
+        response = client.get(next_page)
+
+
+def get_template_values(template):
+    """Fields of WhatsApp Templates as described by a Meta template."""
+    values = {
+        "status": template["status"],
+        "language_code": template["language"],
+        "category": template["category"],
+        "id": template["id"],
+    }
+
+    # update components
+    for component in template["components"]:
+        # update header
+        if component["type"] == "HEADER":
+            values["header_type"] = component["format"]
+
+            # if format is text update sample text
+            if component["format"] == "TEXT":
+                values["header"] = component["text"]
+        # Update footer text
+        elif component["type"] == "FOOTER":
+            values["footer"] = component["text"]
+
+        # update template text
+        elif component["type"] == "BODY":
+            values["template"] = component["text"]
+            if component.get("example"):
+                values["sample_values"] = ",".join(
+                    component["example"]["body_text"][0]
                 )
-            else:
-                flags = 0
-                doc = frappe.new_doc("WhatsApp Templates")
-                doc.template_name = template["name"]
-                doc.actual_name = template["name"]
-
-            doc.status = template["status"]
-            doc.language_code = template["language"]
-            doc.category = template["category"]
-            doc.id = template["id"]
-
-            # update components
-            for component in template["components"]:
-
-                # update header
-                if component["type"] == "HEADER":
-                    doc.header_type = component["format"]
-
-                    # if format is text update sample text
-                    if component["format"] == "TEXT":
-                        doc.header = component["text"]
-                # Update footer text
-                elif component["type"] == "FOOTER":
-                    doc.footer = component["text"]
-
-                # update template text
-                elif component["type"] == "BODY":
-                    doc.template = component["text"]
-                    if component.get("example"):
-                        doc.sample_values = ",".join(
-                            component["example"]["body_text"][0]
-                        )
-
-            # if document exists update else insert
-            # used db_update and db_insert to ignore hooks
-            if flags:
-                doc.db_update()
-            else:
-                doc.db_insert()
-            frappe.db.commit()
 
-    except Exception as e:
-        res = frappe.flags.integration_request.json()["error"]
-        error_message = res.get("error_user_msg", res.get("message"))
-        frappe.throw(
-            msg=error_message,
-            title=res.get("error_user_title", "Error"),
+    return values
+
+
+def get_unique_template_name(actual_name, language_code, taken_names):
+    """The template's name, or with its language when that is taken."""
+    template_name = actual_name
+    if template_name in taken_names:
+        template_name = f"{actual_name}-{language_code}"
+
+    suffix = 1
+    while template_name in taken_names:
+        suffix += 1
+        template_name = f"{actual_name}-{language_code}-{suffix}"
+
+    taken_names.add(template_name)
+    return template_name
+
+
+def get_template_fingerprint(values):
+    """Fingerprint of a template written by the sync, as validate computes it."""
+    doc = frappe.new_doc("WhatsApp Templates")
+    doc.update(values)
+    file_hash = doc.sample_hash if doc.has_media_header() else None
+    return get_content_hash(doc.get_components(header_handle=file_hash or ""))
+
+
+def get_content_hash(values):
+    return hashlib.sha256(
+        json.dumps(values, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def sync_templates_job():
+    """Scheduled template sync, runs in the long queue.
+
+    Meta has no "changed since" filter for message templates, so every
+    run lists them and the content hash keeps unchanged ones untouched.
+    """
+    settings = get_whatsapp_settings()
+    if not (settings.enabled and settings.sync_templates and settings.token):
+        return
+
+    synced_at = frappe.db.get_single_value("WhatsApp Settings", "templates_synced_at")
+    if synced_at and time_diff_in_seconds(now(), synced_at) < MIN_SYNC_INTERVAL:
+        # a manual fetch just ran
+        return
+
+    try:
+        sync_templates()
+    except GraphAPIError:
+        frappe.log_error("WhatsApp Template Sync Failed")
+
+
+def insert_templates(rows):
+    if not rows:
+        return
+
+    timestamp, user = now(), frappe.session.user
+    fields = [
+        "name",
+        "creation",
+        "modified",
+        "owner",
+        "modified_by",
+        "template_name",
+        "actual_name",
+        "content_hash",
+        "fingerprint",
+        *SYNCED_FIELDS,
+    ]
+    values = []
+    for template_name, actual_name, row in rows:
+        doc = frappe.new_doc("WhatsApp Templates")
+        doc.update(row)
+        doc.template_name, doc.actual_name = template_name, actual_name
+        set_new_name(doc)
+        values.append(
+            [doc.name, timestamp, timestamp, user, user]
+            + [doc.template_name, doc.actual_name, row["content_hash"], row["fingerprint"]]
+            + [row.get(field) for field in SYNCED_FIELDS]
         )
 
-    return "Successfully fetched templates from meta"
+    frappe.db.bulk_insert("WhatsApp Templates", fields, values)
@@ -81,7 +81,8 @@ doctype_js = {"Notification": "public/js/notification.js"}
 # ------------
 
 # before_install = "frappe_whatsapp.install.before_install"
-# after_install = "frappe_whatsapp.install.after_install"
+after_install = "frappe_whatsapp.install.after_install"
+after_migrate = "frappe_whatsapp.install.after_migrate"
 
 # Uninstallation
 # ------------
@@ -135,9 +136,17 @@ override_doctype_class = {
 # ---------------
 
 scheduler_events = {
-    "all": ["frappe_whatsapp.utils.trigger_whatsapp_notifications_all"],
+    "all": [
+        "frappe_whatsapp.utils.trigger_whatsapp_notifications_all",
+        "frappe_whatsapp.utils.message_status.flush_statuses",
+        "frappe_whatsapp.utils.outbound_queue.drain_outbound_queue",
+        "frappe_whatsapp.utils.webhook.requeue_stale_webhooks",
+    ],
     "hourly": ["frappe_whatsapp.utils.trigger_whatsapp_notifications_hourly"],
-    "hourly_long": ["frappe_whatsapp.utils.trigger_whatsapp_notifications_hourly_long"],
+    "hourly_long": [
+        "frappe_whatsapp.utils.trigger_whatsapp_notifications_hourly_long",
+        "frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_templates.whatsapp_templates.sync_templates_job",
+    ],
     "daily": [
         "frappe_whatsapp.utils.trigger_whatsapp_notifications_daily",
         "frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_notification.whatsapp_notification.trigger_notifications",
@@ -215,6 +224,32 @@ scheduler_events = {
 # ]
 
 
+# Chatbot keywords, see frappe_whatsapp.utils.intents
+whatsapp_intents = [
+    {
+        "keywords": ["in", "checkin", "out", "checkout", "masuk", "pulang"],
+        "match": "text",
+        "handler": "frappe_whatsapp.utils.webhook.forward_to_n8n",
+    },
+    {
+        "keywords": ["hello"],
+        "match": "text",
+        "handler": "frappe_whatsapp.utils.webhook.reply_hello",
+    },
+    {
+        "keywords": ["production"],
+        "match": "keyword",
+        "handler": "frappe_whatsapp.utils.webhook.reply_production",
+        "site_year": True,
+    },
+    {
+        "keywords": ["stockpile"],
+        "match": "keyword",
+        "handler": "frappe_whatsapp.utils.webhook.reply_stockpile",
+        "site_year": True,
+    },
+]
+
 doc_events = {
     "*": {
         "before_insert": "frappe_whatsapp.utils.run_server_script_for_doc_event",
@@ -230,5 +265,24 @@ doc_events = {
         "after_delete": "frappe_whatsapp.utils.run_server_script_for_doc_event",
         "before_update_after_submit": "frappe_whatsapp.utils.run_server_script_for_doc_event",
         "on_update_after_submit": "frappe_whatsapp.utils.run_server_script_for_doc_event",
-    }
+    },
+    "Site Daily Production Entry": {
+        "on_submit": [
+            "frappe_whatsapp.utils.production_summary.update_production_summary",
+            "frappe_whatsapp.utils.report_cache.clear_report_cache",
+        ],
+        "on_cancel": [
+            "frappe_whatsapp.utils.production_summary.update_production_summary",
+            "frappe_whatsapp.utils.report_cache.clear_report_cache",
+        ],
+    },
+    "Site Location": {
+        "on_update": "frappe_whatsapp.utils.intents.clear_site_abbr_map",
+        "after_rename": "frappe_whatsapp.utils.intents.clear_site_abbr_map",
+        "on_trash": "frappe_whatsapp.utils.intents.clear_site_abbr_map",
+    },
+    "Stockpile Reconciliation": {
+        "on_submit": "frappe_whatsapp.utils.report_cache.clear_report_cache",
+        "on_cancel": "frappe_whatsapp.utils.report_cache.clear_report_cache",
+    },
 }
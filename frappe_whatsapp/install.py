@@ -0,0 +1,25 @@
+import frappe
+
+from frappe_whatsapp.utils.production_summary import rebuild_production_summary
+
+
+def after_install():
+    # patches are marked as done on install, fill the summary here
+    if frappe.db.table_exists("Site Daily Production Entry"):
+        rebuild_production_summary()
+
+
+def after_migrate():
+    add_production_indexes()
+
+
+def add_production_indexes():
+    """Index the chatbot's production lookups on hcapp's doctype."""
+    if not frappe.db.table_exists("Site Daily Production Entry"):
+        return
+
+    frappe.db.add_index(
+        "Site Daily Production Entry",
+        ["docstatus", "site_name", "posting_date", "posting_time"],
+        "docstatus_site_posting_index",
+    )
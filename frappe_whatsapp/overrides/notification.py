@@ -4,11 +4,25 @@ import frappe
 from frappe import _
 from frappe.desk.form.utils import get_pdf_link
 from frappe.email.doctype.notification.notification import Notification, get_context
-from frappe.integrations.utils import make_post_request
 from frappe.model.document import Document
 from frappe.utils import add_to_date, datetime, nowdate
 from frappe.utils.jinja import validate_template
-from frappe.utils.safe_exec import get_safe_globals, safe_exec
+from frappe.utils.safe_exec import safe_exec
+
+from frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_settings.whatsapp_settings import (
+    get_whatsapp_settings,
+)
+from frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_templates.whatsapp_templates import (
+    get_template,
+)
+from frappe_whatsapp.utils.conditions import evaluate_condition
+from frappe_whatsapp.utils.bulk_send import (
+    SendResult,
+    save_send_results,
+    send_and_save,
+)
+from frappe_whatsapp.utils.graph_api import get_client
+from frappe_whatsapp.utils.outbound_queue import queue_message
 
 
 class WhatsappNotification(Notification):
@@ -17,11 +31,8 @@ class WhatsappNotification(Notification):
         super(WhatsappNotification, self).validate()
 
     def validate_whatsapp_settings(self):
-        settings = frappe.get_doc(
-            "WhatsApp Settings",
-            "WhatsApp Settings",
-        )
-        token = settings.get_password("token")
+        settings = get_whatsapp_settings()
+        token = settings.token
 
         if self.enabled and self.channel == "Whatsapp":
             if not token or not settings.url:
@@ -66,17 +77,13 @@ class WhatsappNotification(Notification):
         if not self.enabled:
             return
 
+        # check if condition satisfies, before serializing the doc
+        if not evaluate_condition(self, doc):
+            return
+
         doc_data = doc.as_dict()
-        if self.condition:
-            # check if condition satisfies
-            if not frappe.safe_eval(
-                self.condition, get_safe_globals(), dict(doc=doc_data)
-            ):
-                return
-
-        template = frappe.db.get_value(
-            "WhatsApp Templates", self.custom_template, fieldname="*"
-        )
+
+        template = get_template(self.custom_template)
 
         recipients = self.get_receiver_list(doc, context)
 
@@ -172,6 +179,7 @@ class WhatsappNotification(Notification):
 
             recipient_number = [x for x in recipients if x is not None]
 
+            payloads = []
             for recipient in recipient_number:
                 number = recipient
                 if "{" in number:
@@ -191,7 +199,9 @@ class WhatsappNotification(Notification):
 
                 self.content_type = template.header_type.lower()
 
-                self.notify(data)
+                payloads.append(data)
+
+            self.notify_bulk(payloads)
         else:
             frappe.log_error(
                 title="Failed to send notification", message=f"{recipients}"
@@ -199,65 +209,53 @@ class WhatsappNotification(Notification):
 
     def notify(self, data):
         """Notify."""
-        settings = frappe.get_doc(
-            "WhatsApp Settings",
-            "WhatsApp Settings",
-        )
-        token = settings.get_password("token")
+        if get_whatsapp_settings().queue_outgoing_messages:
+            queue_message(
+                data,
+                message=str(data["template"]),
+                message_type="Template",
+                content_type=self.get("content_type") or "text",
+            )
+            return
 
-        headers = {
-            "authorization": f"Bearer {token}",
-            "content-type": "application/json",
-        }
         try:
-            success = False
-            response = make_post_request(
-                f"{settings.url}/{settings.version}/{settings.phone_id}/messages",
-                headers=headers,
-                data=json.dumps(data),
+            result = SendResult(data, get_client().send_message(data), None)
+            frappe.msgprint("Whatsapp notification sent", indicator="green", alert=True)
+
+        except Exception as e:
+            result = SendResult(data, None, e)
+            frappe.msgprint(
+                f"Failed to trigger whatsapp notification: {str(e)}",
+                indicator="red",
+                alert=True,
             )
 
-            if not self.get("content_type"):
-                self.content_type = "text"
-
-            frappe.get_doc(
-                {
-                    "doctype": "WhatsApp Message",
-                    "type": "Outgoing",
-                    "message": str(data["template"]),
-                    "to": data["to"],
-                    "message_type": "Template",
-                    "message_id": response["messages"][0]["id"],
-                    "content_type": self.content_type,
-                }
-            ).save(ignore_permissions=True)
+        save_send_results(
+            [result], template=self.custom_template, content_type=self.get("content_type")
+        )
 
-            frappe.msgprint("Whatsapp notification sent", indicator="green", alert=True)
-            success = True
+    def notify_bulk(self, payloads):
+        """Send to many recipients concurrently."""
+        if not payloads:
+            return
 
-        except Exception as e:
-            error_message = str(e)
-            if frappe.flags.integration_request:
-                response = frappe.flags.integration_request.json()["error"]
-                error_message = response.get("Error", response.get("message"))
+        if len(payloads) == 1 or get_whatsapp_settings().queue_outgoing_messages:
+            for data in payloads:
+                self.notify(data)
+            return
 
+        results = send_and_save(
+            payloads, template=self.custom_template, content_type=self.get("content_type")
+        )
+        failed = [result for result in results if result.error]
+        if failed:
             frappe.msgprint(
-                f"Failed to trigger whatsapp notification: {error_message}",
+                f"Failed to trigger whatsapp notification for {len(failed)} of {len(results)} recipients: {failed[0].error.message}",
                 indicator="red",
                 alert=True,
             )
-        finally:
-            if not success:
-                meta = {"error": error_message}
-            else:
-                meta = frappe.flags.integration_request.json()
-            frappe.get_doc(
-                {
-                    "doctype": "WhatsApp Notification Log",
-                    "template": self.custom_template,
-                    "meta_data": meta,
-                }
-            ).insert(ignore_permissions=True)
+        else:
+            frappe.msgprint("Whatsapp notification sent", indicator="green", alert=True)
 
     # def send_whatsapp_message(self, doc, context):
     #     recipients = self.get_receiver_list(doc, context)
@@ -0,0 +1,10 @@
+import frappe
+
+from frappe_whatsapp.utils.production_summary import rebuild_production_summary
+
+
+def execute():
+    if not frappe.db.table_exists("Site Daily Production Entry"):
+        return
+
+    rebuild_production_summary()
@@ -1,11 +1,49 @@
 """Run on each event."""
+import time
+from collections import Counter
+
 import frappe
 
-from frappe.core.doctype.server_script.server_script_utils import EVENT_MAP
+from frappe.core.doctype.server_script.server_script_utils import (
+    EVENT_MAP,
+    get_server_script_map,
+)
+from frappe.utils import cint
+
+from frappe_whatsapp.utils.cache import clear_cached_value, get_cached_value
+
+NOTIFICATION_MAP_KEY = "whatsapp_notification_map"
+SKIPPED_DISPATCH_KEY = "whatsapp_skipped_dispatches"
+SKIPPED_FLUSH_COUNT = 100
+SKIPPED_FLUSH_INTERVAL = 60
+
+# doctypes that can never have WhatsApp notifications, mostly logs written
+# while sending or receiving messages, so they must not re-enter dispatch
+IGNORED_DOCTYPES = frozenset(
+    (
+        "WhatsApp Message",
+        "WhatsApp Notification Log",
+        "Error Log",
+        "Integration Request",
+        "Version",
+        "Access Log",
+        "Activity Log",
+        "Scheduled Job Log",
+        "Route History",
+    )
+)
+
+# {site: Counter(doctype -> skips not yet added to Redis)}
+_pending_skips = {}
+_last_skip_flush = {}
 
 
 def run_server_script_for_doc_event(doc, event):
     """Run on each event."""
+    if doc.doctype in IGNORED_DOCTYPES:
+        count_skipped_dispatch(doc.doctype)
+        return
+
     if event not in EVENT_MAP:
         return
 
@@ -18,9 +56,11 @@ def run_server_script_for_doc_event(doc, event):
     if frappe.flags.in_uninstall:
         return
 
-    notification = get_notifications_map().get(
-        doc.doctype, {}
-    ).get(EVENT_MAP[event], None)
+    doctype_notifications = get_notifications_map().get(doc.doctype)
+    if not doctype_notifications:
+        return
+
+    notification = doctype_notifications.get(EVENT_MAP[event], None)
 
     if notification:
         # run all scripts for this doctype + event
@@ -36,6 +76,11 @@ def get_notifications_map():
     if frappe.flags.in_patch and not frappe.db.table_exists("WhatsApp Notification"):
         return {}
 
+    return get_cached_value(NOTIFICATION_MAP_KEY, build_notifications_map)
+
+
+def build_notifications_map():
+    """Build doctype -> event -> notification names mapping."""
     notification_map = {}
     enabled_whatsapp_notifications = frappe.get_all(
         "WhatsApp Notification",
@@ -50,11 +95,85 @@ def get_notifications_map():
                 notification.doctype_event, []
             ).append(notification.name)
 
-    frappe.cache().set_value("whatsapp_notification_map", notification_map)
-
     return notification_map
 
 
+def clear_notifications_map():
+    """Rebuild mapping on next lookup."""
+    clear_cached_value(NOTIFICATION_MAP_KEY)
+
+
+def count_skipped_dispatch(doctype):
+    """Count a skip in process, added to Redis every few skips or seconds."""
+    site = frappe.local.site
+    pending = _pending_skips.setdefault(site, Counter())
+    pending[doctype] += 1
+
+    last_flush = _last_skip_flush.setdefault(site, time.monotonic())
+    if (
+        pending.total() >= SKIPPED_FLUSH_COUNT
+        or time.monotonic() - last_flush >= SKIPPED_FLUSH_INTERVAL
+    ):
+        flush_skipped_dispatches()
+
+
+def flush_skipped_dispatches():
+    site = frappe.local.site
+    pending = _pending_skips.pop(site, None)
+    _last_skip_flush[site] = time.monotonic()
+    if not pending:
+        return
+
+    cache = frappe.cache()
+    for doctype, count in pending.items():
+        cache.incrby(cache.make_key(f"{SKIPPED_DISPATCH_KEY}:{doctype}"), count)
+
+
+@frappe.whitelist()
+def get_dispatch_stats():
+    """Dispatches skipped for ignored doctypes, over all processes of the site.
+
+    Each process adds its counts every few skips or seconds, so the last
+    ones may not be included yet.
+    """
+    frappe.only_for("System Manager")
+
+    flush_skipped_dispatches()
+    cache = frappe.cache()
+    by_doctype = {}
+    for doctype in sorted(IGNORED_DOCTYPES):
+        count = cint(cache.get(cache.make_key(f"{SKIPPED_DISPATCH_KEY}:{doctype}")))
+        if count:
+            by_doctype[doctype] = count
+
+    return {"skipped": sum(by_doctype.values()), "by_doctype": by_doctype}
+
+
+def has_doc_event_subscribers(doctype):
+    """Whether anything listens to events of `doctype`.
+
+    Bulk writes skip document hooks, so they are only used when nothing
+    (WhatsApp Notification, doc_events of another app, Server Script or
+    Notification) would miss them.
+    """
+    if get_notifications_map().get(doctype):
+        return True
+
+    if doctype in (frappe.get_hooks("doc_events") or {}):
+        return True
+
+    if get_server_script_map().get(doctype):
+        return True
+
+    return bool(
+        frappe.get_all(
+            "Notification",
+            filters={"document_type": doctype, "enabled": 1},
+            limit=1,
+        )
+    )
+
+
 def trigger_whatsapp_notifications_all():
     """Run all."""
     trigger_whatsapp_notifications("All")
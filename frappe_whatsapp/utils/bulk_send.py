@@ -0,0 +1,120 @@
+"""Concurrent sending of many messages, e.g. a notification to all recipients."""
+
+import json
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import frappe
+from frappe.utils import now
+
+from frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_settings.whatsapp_settings import (
+    get_whatsapp_settings,
+)
+from frappe_whatsapp.utils import has_doc_event_subscribers
+from frappe_whatsapp.utils.graph_api import GraphAPIError, get_client
+
+DEFAULT_CONCURRENCY = 8
+
+SendResult = namedtuple("SendResult", ["data", "response", "error"])
+
+
+def send_bulk(payloads, concurrency=None):
+    """Send Graph API payloads keeping `concurrency` requests in flight.
+
+    Returns a SendResult per payload, in order. Worker threads only talk
+    to the Graph API, all database work is left to the caller.
+    """
+    if not payloads:
+        return []
+
+    concurrency = (
+        concurrency
+        or get_whatsapp_settings().bulk_send_concurrency
+        or DEFAULT_CONCURRENCY
+    )
+    client = get_client()
+
+    def send(data):
+        # every error stays with its payload, one raised here would lose the
+        # results of the messages already sent
+        try:
+            response = client.send_message(data)
+        except Exception as e:
+            return SendResult(data, None, e)
+
+        if not get_message_id(response):
+            error = GraphAPIError("Response without a message id", data=response)
+            return SendResult(data, None, error)
+
+        return SendResult(data, response, None)
+
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(payloads))) as executor:
+        return list(executor.map(send, payloads))
+
+
+def send_and_save(payloads, template=None, content_type=None):
+    """Send payloads concurrently, then save messages and logs together."""
+    results = send_bulk(payloads)
+    save_send_results(results, template=template, content_type=content_type)
+    return results
+
+
+def save_send_results(results, template=None, content_type=None):
+    """Save WhatsApp Message and WhatsApp Notification Log rows for sends.
+
+    Rows are written with one INSERT per doctype, skipping document hooks
+    (and so the "*" doc_events dispatcher) unless something subscribes to
+    them.
+    """
+    messages, logs = [], []
+    for result in results:
+        if not result.error:
+            messages.append(
+                {
+                    "type": "Outgoing",
+                    "message": str(result.data["template"]),
+                    "to": result.data["to"],
+                    "message_type": "Template",
+                    "message_id": get_message_id(result.response),
+                    "content_type": content_type or "text",
+                }
+            )
+
+        logs.append(
+            {
+                "template": template,
+                "meta_data": json.dumps(
+                    result.response if not result.error else {"error": str(result.error)}
+                ),
+            }
+        )
+
+    bulk_insert("WhatsApp Message", messages)
+    bulk_insert("WhatsApp Notification Log", logs)
+
+
+def get_message_id(response):
+    """Id of the sent message, None if the response has none."""
+    try:
+        return response["messages"][0]["id"]
+    except (KeyError, IndexError, TypeError):
+        return None
+
+
+def bulk_insert(doctype, rows):
+    """Insert plain rows of `doctype`, through documents if hooks are needed."""
+    if not rows:
+        return
+
+    if has_doc_event_subscribers(doctype):
+        for row in rows:
+            frappe.get_doc({"doctype": doctype, **row}).insert(ignore_permissions=True)
+        return
+
+    timestamp, user = now(), frappe.session.user
+    fields = ["name", "creation", "modified", "owner", "modified_by", *rows[0]]
+    values = [
+        [frappe.generate_hash(length=10), timestamp, timestamp, user, user, *row.values()]
+        for row in rows
+    ]
+    frappe.db.bulk_insert(doctype, fields, values)
@@ -0,0 +1,64 @@
+"""Per-process caches kept coherent across workers with a Redis version stamp."""
+
+import frappe
+
+# stale versions are never read again, let Redis drop them
+VALUE_EXPIRY = 24 * 60 * 60
+
+# {(site, key): (version, value)}
+_process_cache = {}
+
+
+def get_cached_value(key, generator, shared=True):
+    """Return cached value for `key`, building it with `generator` on a miss.
+
+    The value is kept in this process and, unless `shared` is False (e.g. for
+    secrets), in Redis. Every process compares its copy against a shared
+    version stamp, which is read from Redis once per request (frappe memoizes
+    `get_value` in `frappe.local.cache`), so repeat lookups within a request
+    are plain dict reads.
+    """
+    cache = frappe.cache()
+    version = cache.get_value(_version_key(key))
+    if not version:
+        version = frappe.generate_hash(length=10)
+        cache.set_value(_version_key(key), version)
+
+    local_key = (frappe.local.site, key)
+    cached = _process_cache.get(local_key)
+    if cached and cached[0] == version:
+        return cached[1]
+
+    value = cache.get_value(_value_key(key, version)) if shared else None
+    if value is None:
+        value = generator()
+        if shared:
+            cache.set_value(
+                _value_key(key, version), value, expires_in_sec=VALUE_EXPIRY
+            )
+
+    _process_cache[local_key] = (version, value)
+    return value
+
+
+def clear_cached_value(key):
+    """Invalidate `key` in every process.
+
+    Cleared again after commit so that a process rebuilding the value in
+    between does not keep the pre-commit state.
+    """
+    _clear(key)
+    frappe.db.after_commit.add(lambda: _clear(key))
+
+
+def _clear(key):
+    frappe.cache().delete_value(_version_key(key))
+    _process_cache.pop((frappe.local.site, key), None)
+
+
+def _version_key(key):
+    return f"{key}:version"
+
+
+def _value_key(key, version):
+    return f"{key}:{version}"
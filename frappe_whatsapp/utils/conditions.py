@@ -0,0 +1,88 @@
+"""Notification conditions, compiled once per notification revision.
+
+Evaluation follows `frappe.safe_eval` (same restricted compiler, syntax
+checks and whitelisted globals) but keeps the compiled code per process
+and builds the safe globals once per request or job.
+"""
+
+import unicodedata
+
+import frappe
+from frappe.utils.safe_exec import (
+    WHITELISTED_SAFE_EVAL_GLOBALS,
+    FrappeTransformer,
+    _validate_safe_eval_syntax,
+    get_safe_globals,
+)
+from RestrictedPython import compile_restricted
+
+# {(site, doctype, name, modified): code}
+_compiled_conditions = {}
+
+
+class LazyDocView:
+    """Read-only view of a document for conditions.
+
+    Fields are read on access instead of serializing the whole document
+    (and its child tables) with `as_dict` up front.
+    """
+
+    __slots__ = ("_doc",)
+
+    def __init__(self, doc):
+        self._doc = doc
+
+    def __getattr__(self, fieldname):
+        return self._doc.get(fieldname)
+
+    def __getitem__(self, fieldname):
+        return self._doc.get(fieldname)
+
+    def __contains__(self, fieldname):
+        return self._doc.get(fieldname) is not None
+
+    def get(self, fieldname, default=None):
+        value = self._doc.get(fieldname)
+        return default if value is None else value
+
+
+def evaluate_condition(notification, doc):
+    """Evaluate the condition of `notification` against `doc`."""
+    if not notification.condition:
+        return True
+
+    code = get_compiled_condition(notification)
+    return eval(code, get_eval_globals(), {"doc": LazyDocView(doc)})  # nosemgrep
+
+
+def get_compiled_condition(notification):
+    key = (
+        frappe.local.site,
+        notification.doctype,
+        notification.name,
+        str(notification.modified),
+    )
+    code = _compiled_conditions.get(key)
+    if code is None:
+        code = _compiled_conditions[key] = compile_condition(notification.condition)
+
+    return code
+
+
+def compile_condition(condition):
+    condition = unicodedata.normalize("NFKC", condition)
+    _validate_safe_eval_syntax(condition)
+    return compile_restricted(
+        condition, filename="<safe_eval>", policy=FrappeTransformer, mode="eval"
+    )
+
+
+def get_eval_globals():
+    """Safe globals, built once per request or job."""
+    if not frappe.flags.whatsapp_eval_globals:
+        eval_globals = get_safe_globals()
+        eval_globals["__builtins__"] = {}
+        eval_globals.update(WHITELISTED_SAFE_EVAL_GLOBALS)
+        frappe.flags.whatsapp_eval_globals = eval_globals
+
+    return frappe.flags.whatsapp_eval_globals
@@ -0,0 +1,163 @@
+"""Graph API client shared by all outbound calls.
+
+Connections to graph.facebook.com are kept alive in a per-process pool.
+Transport is tuned from site config:
+
+- `whatsapp_pool_size`: connections kept per host (default 10)
+- `whatsapp_connect_timeout`: seconds (default 5)
+- `whatsapp_read_timeout`: seconds (default 30)
+"""
+
+import frappe
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_settings.whatsapp_settings import (
+    get_whatsapp_settings,
+)
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 30
+
+# {pool_size: session}
+_sessions = {}
+
+
+class GraphAPIError(frappe.ValidationError):
+    """Error returned by (or while reaching) the Graph API."""
+
+    def __init__(
+        self,
+        message,
+        status_code=None,
+        code=None,
+        error_subcode=None,
+        title=None,
+        user_message=None,
+        data=None,
+    ):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+        self.code = code
+        self.error_subcode = error_subcode
+        self.title = title
+        self.user_message = user_message
+        self.data = data or {"error": {"message": message}}
+
+    @classmethod
+    def from_response(cls, response):
+        try:
+            data = response.json()
+        except ValueError:
+            data = {"error": {"message": response.text or response.reason}}
+
+        error = data.get("error") or {}
+        return cls(
+            error.get("message") or response.reason,
+            status_code=response.status_code,
+            code=error.get("code"),
+            error_subcode=error.get("error_subcode"),
+            title=error.get("error_user_title"),
+            user_message=error.get("error_user_msg"),
+            data=data,
+        )
+
+
+class GraphAPIClient:
+    """Client for the WhatsApp Cloud API.
+
+    Build it in the request/job context, after that it does not touch
+    frappe locals and can be used from worker threads.
+    """
+
+    def __init__(self, url, version, token, phone_id=None, business_id=None, app_id=None):
+        self.base_url = f"{url}/{version}"
+        self.token = token
+        self.phone_id = phone_id
+        self.business_id = business_id
+        self.app_id = app_id
+
+        conf = frappe.conf
+        self.timeout = (
+            conf.get("whatsapp_connect_timeout") or DEFAULT_CONNECT_TIMEOUT,
+            conf.get("whatsapp_read_timeout") or DEFAULT_READ_TIMEOUT,
+        )
+        self.session = get_session(conf.get("whatsapp_pool_size") or DEFAULT_POOL_SIZE)
+
+    @classmethod
+    def from_settings(cls):
+        settings = get_whatsapp_settings()
+        return cls(
+            settings.url,
+            settings.version,
+            settings.token,
+            phone_id=settings.phone_id,
+            business_id=settings.business_id,
+            app_id=settings.app_id,
+        )
+
+    def request(self, method, path, headers=None, auth_scheme="Bearer", **kwargs):
+        """Call `path` (relative to url/version, or absolute) and return json."""
+        response = self.raw_request(method, path, headers, auth_scheme, **kwargs)
+        return response.json() if response.content else {}
+
+    def raw_request(self, method, path, headers=None, auth_scheme="Bearer", **kwargs):
+        """Call `path` and return the response object, raise GraphAPIError on errors."""
+        url = path if path.startswith("http") else f"{self.base_url}/{path.lstrip('/')}"
+        headers = {"authorization": f"{auth_scheme} {self.token}", **(headers or {})}
+        kwargs.setdefault("timeout", self.timeout)
+
+        try:
+            response = self.session.request(method, url, headers=headers, **kwargs)
+        except requests.RequestException as e:
+            raise GraphAPIError(str(e)) from e
+
+        if not response.ok:
+            raise GraphAPIError.from_response(response)
+
+        return response
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request("DELETE", path, **kwargs)
+
+    def send_message(self, data):
+        """Send a message payload from the configured phone number."""
+        return self.post(f"{self.phone_id}/messages", json=data)
+
+
+def get_client():
+    """Graph API client for the current site."""
+    return GraphAPIClient.from_settings()
+
+
+def get_session(pool_size=DEFAULT_POOL_SIZE):
+    """Keep-alive session of this process."""
+    session = _sessions.get(pool_size)
+    if not session:
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            # only idempotent calls are retried, sends are never repeated
+            max_retries=Retry(
+                total=2,
+                backoff_factor=0.3,
+                status_forcelist=(502, 503, 504),
+                allowed_methods=("GET", "HEAD"),
+                raise_on_status=False,
+            ),
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _sessions[pool_size] = session
+
+    return session
@@ -0,0 +1,120 @@
+"""Keyword router for incoming text messages.
+
+Intents are declared by apps in the `whatsapp_intents` hook:
+
+    whatsapp_intents = [
+        {
+            "keywords": ["production"],
+            "match": "keyword",      # first word of the message
+            "handler": "my_app.bot.reply_production",
+            "site_year": True,       # expects "<keyword> <site abbr> <year>"
+        },
+        {
+            "keywords": ["hello"],
+            "match": "text",         # whole message, spaces removed
+            "handler": "my_app.bot.reply_hello",
+        },
+    ]
+
+Handlers get a context with `sender`, `text`, `message`, `data` and, for
+`site_year` intents, `keyword`, `site_name` and `year`. A returned string
+is sent back as the reply. Intents of later apps override earlier ones
+for the same keyword.
+"""
+
+import re
+
+import frappe
+
+from frappe_whatsapp.utils.cache import clear_cached_value, get_cached_value
+
+SITE_ABBR_MAP_KEY = "whatsapp_site_abbr_map"
+YEAR_PATTERN = re.compile(r"^\d{4}$")
+
+FORMAT_HINT = "Please type your keyword with correct format (eg: 'production ptp 2025' or 'stockpile ptp 2025')"
+
+# {site: {"text": {...}, "keyword": {...}}}
+_intent_tables = {}
+
+
+def route_text_message(message, data):
+    """Run the intent matching an incoming text message."""
+    text = message["text"]["body"] or ""
+    context = frappe._dict(
+        {"sender": message["from"], "text": text, "message": message, "data": data}
+    )
+
+    intent = match_intent(text, context)
+    if not intent:
+        return FORMAT_HINT
+
+    return frappe.get_attr(intent["handler"])(context)
+
+
+def match_intent(text, context):
+    """Matching intent, with its arguments set on `context`.
+
+    Unknown keywords are rejected from the precompiled table before any
+    database access.
+    """
+    table = get_intent_table()
+
+    intent = table["text"].get(text.replace(" ", "").lower())
+    if intent:
+        return intent
+
+    words = text.lower().split()
+    intent = table["keyword"].get(words[0]) if words else None
+    if not intent:
+        return None
+
+    if intent.get("site_year"):
+        if len(words) < 3 or not YEAR_PATTERN.match(words[2]):
+            return None
+
+        site_name = get_site_abbr_map().get(words[1])
+        if not site_name:
+            return None
+
+        context.update({"keyword": words[0], "site_name": site_name, "year": words[2]})
+
+    return intent
+
+
+def get_intent_table():
+    site = frappe.local.site
+    table = _intent_tables.get(site)
+    if not table:
+        table = _intent_tables[site] = build_intent_table(
+            frappe.get_hooks("whatsapp_intents")
+        )
+
+    return table
+
+
+def build_intent_table(intents):
+    table = {"text": {}, "keyword": {}}
+    for intent in intents:
+        match = intent.get("match") or "keyword"
+        for keyword in intent["keywords"]:
+            key = keyword.replace(" ", "").lower() if match == "text" else keyword.lower()
+            table[match][key] = intent
+
+    return table
+
+
+def get_site_abbr_map():
+    """Site Location names by lowercase abbreviation."""
+    return get_cached_value(SITE_ABBR_MAP_KEY, build_site_abbr_map)
+
+
+def build_site_abbr_map():
+    return {
+        site.site_abbr.lower(): site.name
+        for site in frappe.get_all("Site Location", fields=["name", "site_abbr"])
+        if site.site_abbr
+    }
+
+
+def clear_site_abbr_map(doc=None, method=None, *args):
+    clear_cached_value(SITE_ABBR_MAP_KEY)
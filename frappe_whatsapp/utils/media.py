@@ -0,0 +1,221 @@
+"""Inbound media, downloaded off the webhook request.
+
+The WhatsApp Message is saved by the webhook, a background job streams the
+media to the site's private files and fills in `attach` when done.
+"""
+
+import hashlib
+import json
+import mimetypes
+import os
+import re
+
+import frappe
+import requests
+from frappe.utils import cint, flt, get_files_path
+
+from frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_settings.whatsapp_settings import (
+    get_whatsapp_settings,
+)
+from frappe_whatsapp.utils.graph_api import GraphAPIError, get_client
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+SHA256_PATTERN = re.compile(r"[0-9a-f]{64}")
+MEDIA_METADATA_KEY = "whatsapp_media_metadata"
+MEDIA_METADATA_EXPIRY = 4 * 60
+
+# types WhatsApp sends where mimetypes guesses badly or not at all
+MIME_TYPE_EXTENSIONS = {
+    "audio/aac": ".aac",
+    "audio/amr": ".amr",
+    "audio/mp4": ".m4a",
+    "audio/mpeg": ".mp3",
+    "audio/ogg": ".ogg",
+    "image/jpeg": ".jpg",
+    "image/webp": ".webp",
+    "text/plain": ".txt",
+    "video/3gpp": ".3gp",
+    "video/mp4": ".mp4",
+}
+
+
+def enqueue_media_download(message_name, media_id):
+    frappe.enqueue(
+        download_media,
+        queue="long",
+        enqueue_after_commit=True,
+        message_name=message_name,
+        media_id=media_id,
+    )
+
+
+def download_media(message_name, media_id):
+    """Download media of an incoming message and attach it.
+
+    Files are stored by the SHA-256 of their content (Meta sends it with
+    the media metadata), so media forwarded again is not downloaded and
+    written again. Each message still gets its own File row, which keeps
+    the shared file on disk until the last message using it is deleted.
+    """
+    client = get_client()
+    try:
+        media_data = get_media_metadata(client, media_id)
+        file_extension = get_file_extension(media_data.get("mime_type"))
+
+        max_size = cint(get_whatsapp_settings().max_media_size) * 1024 * 1024
+        if max_size and cint(media_data.get("file_size")) > max_size:
+            save_reference(message_name, media_id, media_data)
+            return
+
+        sha256 = media_data.get("sha256")
+        if not is_sha256(sha256):
+            sha256 = None
+
+        stored = get_stored_file(f"{sha256}.{file_extension}") if sha256 else None
+        if not stored:
+            response = client.raw_request("GET", media_data["url"], stream=True)
+            temp_path = get_files_path(
+                f"{frappe.generate_hash(length=10)}.part", is_private=1
+            )
+            content = save_stream(response, temp_path)
+            if sha256 and content.sha256 != sha256:
+                frappe.log_error(
+                    title="WA Media Checksum Mismatch",
+                    message=f"Media {media_id}: Meta sent {sha256}, downloaded {content.sha256}",
+                )
+
+            # the address is always what was actually downloaded
+            stored = store_file(temp_path, content, file_extension)
+    except GraphAPIError:
+        frappe.log_error(title="WA Media Download Failed")
+        return
+
+    file_url = attach_file(message_name, stored)
+    message_doc = frappe.get_doc("WhatsApp Message", message_name)
+    message_doc.attach = file_url
+    if not message_doc.message:
+        message_doc.message = file_url
+    message_doc.save(ignore_permissions=True)
+
+
+def get_media_metadata(client, media_id):
+    """url, mime_type, file_size and sha256 of a media id, cached briefly."""
+    key = f"{MEDIA_METADATA_KEY}:{media_id}"
+    media_data = frappe.cache().get_value(key)
+    if not media_data:
+        media_data = client.get(f"{media_id}/")
+        # media urls expire after five minutes
+        frappe.cache().set_value(key, media_data, expires_in_sec=MEDIA_METADATA_EXPIRY)
+
+    return media_data
+
+
+def get_file_extension(mime_type):
+    """Extension for a MIME type such as 'audio/ogg; codecs=opus'."""
+    mime_type = (mime_type or "").split(";")[0].strip().lower()
+    extension = MIME_TYPE_EXTENSIONS.get(mime_type) or mimetypes.guess_extension(mime_type)
+    return (extension or ".bin").lstrip(".")
+
+
+def save_reference(message_name, media_id, media_data):
+    """Record media over the size limit on the message without downloading it."""
+    message_doc = frappe.get_doc("WhatsApp Message", message_name)
+    message_doc.payload = json.dumps(
+        {
+            "media_id": media_id,
+            "mime_type": media_data.get("mime_type"),
+            "file_size": media_data.get("file_size"),
+            "sha256": media_data.get("sha256"),
+        }
+    )
+    if not message_doc.message:
+        size = flt(cint(media_data.get("file_size")) / 1024 / 1024, 1)
+        message_doc.message = f"Media of {size} MB not downloaded, it is larger than the limit"
+    message_doc.save(ignore_permissions=True)
+
+
+def save_stream(response, path):
+    """Write the response body to `path` chunk by chunk.
+
+    Returns its SHA-256, its size and the MD5 File rows keep as
+    `content_hash`, all taken from the chunks as they are written.
+    """
+    sha256, md5, file_size = hashlib.sha256(), hashlib.md5(usedforsecurity=False), 0
+    try:
+        with response, open(path, "wb") as file:
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                sha256.update(chunk)
+                md5.update(chunk)
+                file_size += len(chunk)
+                file.write(chunk)
+    except requests.RequestException as e:
+        if os.path.exists(path):
+            os.remove(path)
+        raise GraphAPIError(str(e)) from e
+
+    return frappe._dict(
+        sha256=sha256.hexdigest(), content_hash=md5.hexdigest(), file_size=file_size
+    )
+
+
+def store_file(temp_path, content, file_extension):
+    """Move a download to its content address, return what its File rows need."""
+    file_name = f"{content.sha256}.{file_extension}"
+    path = get_files_path(file_name, is_private=1)
+    if os.path.exists(path):
+        # saved meanwhile, e.g. by a concurrent download of the same media
+        os.remove(temp_path)
+    else:
+        os.replace(temp_path, path)
+
+    return frappe._dict(
+        file_name=file_name,
+        file_url=f"/private/files/{file_name}",
+        file_size=content.file_size,
+        content_hash=content.content_hash,
+    )
+
+
+def attach_file(message_name, stored):
+    """Add a File row of the message for a stored media file.
+
+    The row is written directly: File.insert would read the whole file
+    back into memory and, finding the name taken, save a second copy.
+    """
+    file = frappe.new_doc("File")
+    file.update(
+        {
+            "file_name": stored.file_name,
+            "file_url": stored.file_url,
+            "file_size": stored.file_size,
+            "content_hash": stored.content_hash,
+            "is_private": 1,
+            "folder": "Home/Attachments",
+            "attached_to_doctype": "WhatsApp Message",
+            "attached_to_name": message_name,
+            "attached_to_field": "attach",
+        }
+    )
+    file.db_insert()
+
+    return file.file_url
+
+
+def get_stored_file(file_name):
+    """File row of media stored under this content address, if still on disk."""
+    stored = frappe.db.get_value(
+        "File",
+        {
+            "file_name": file_name,
+            "is_private": 1,
+            "attached_to_doctype": "WhatsApp Message",
+        },
+        ["file_name", "file_url", "file_size", "content_hash"],
+        as_dict=True,
+    )
+    if stored and os.path.exists(frappe.get_site_path(stored.file_url.lstrip("/"))):
+        return stored
+
+
+def is_sha256(value):
+    return bool(value and SHA256_PATTERN.fullmatch(value))
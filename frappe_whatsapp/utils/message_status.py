@@ -0,0 +1,248 @@
+"""Bulk update of WhatsApp Message status from delivery receipts."""
+
+import json
+import time
+
+import frappe
+from frappe.utils import now
+from redis.exceptions import LockError
+
+from frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_message.whatsapp_message import (
+    get_messages_by_wamid,
+)
+from frappe_whatsapp.utils import has_doc_event_subscribers
+
+STATUS_BUFFER_KEY = "whatsapp_status_buffer"
+STATUS_FLUSH_LOCK = "whatsapp_status_flush"
+STATUS_DEAD_LETTER_KEY = "whatsapp_status_dead_letter"
+DEAD_LETTER_SIZE = 10000
+BATCH_SIZE = 500
+TRANSIENT_ERROR_RETRIES = 3
+
+# receipts never move a message back, failed wins over everything
+STATUS_RANK = {"sent": 1, "delivered": 2, "read": 3, "failed": 4}
+
+
+def queue_statuses(statuses):
+    """Buffer receipts, they are applied in batches by a background job."""
+    if not statuses:
+        return
+
+    cache = frappe.cache()
+    for status in statuses:
+        cache.rpush(STATUS_BUFFER_KEY, json.dumps(status))
+
+    # the first push of a window schedules the flush, later pushes ride along
+    if cache.llen(STATUS_BUFFER_KEY) <= len(statuses):
+        frappe.enqueue(flush_statuses, queue="short", enqueue_after_commit=True)
+
+
+def flush_statuses():
+    """Apply buffered receipts. Also scheduled to pick up missed windows."""
+    cache = frappe.cache()
+    lock = cache.lock(cache.make_key(STATUS_FLUSH_LOCK), timeout=300)
+    if not lock.acquire(blocking=False):
+        return
+
+    try:
+        while True:
+            batch = cache.lrange(STATUS_BUFFER_KEY, 0, BATCH_SIZE - 1)
+            if not batch:
+                break
+
+            try:
+                apply_statuses(batch)
+            except Exception:
+                # still deadlocked or waiting on locks after the retries,
+                # the batch stays buffered for the next flush
+                frappe.log_error(title="WA Status Batch Deferred")
+                break
+
+            cache.ltrim(STATUS_BUFFER_KEY, len(batch), -1)
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            # expired while a slow batch ran
+            pass
+
+
+def apply_statuses(batch):
+    """Apply buffered receipts, dead-lettering only those that fail on their own.
+
+    A failing batch is split in halves until the receipts that fail are
+    isolated, so one bad receipt does not take the rest of its batch
+    with it. Transient errors are raised to keep the batch buffered.
+    """
+    try:
+        apply_with_retry(batch)
+    except Exception as e:
+        if is_transient_error(e):
+            raise
+
+        if len(batch) == 1:
+            frappe.log_error(title="WA Status Receipt Failed", message=batch[0])
+            move_to_dead_letter(batch)
+            return
+
+        middle = len(batch) // 2
+        apply_statuses(batch[:middle])
+        apply_statuses(batch[middle:])
+
+
+def apply_with_retry(batch):
+    """Apply and commit a batch, retrying deadlocks and lock wait timeouts."""
+    for attempt in range(TRANSIENT_ERROR_RETRIES):
+        try:
+            update_message_statuses([json.loads(status) for status in batch])
+            frappe.db.commit()
+            return
+        except Exception as e:
+            frappe.db.rollback()
+            if not is_transient_error(e) or attempt == TRANSIENT_ERROR_RETRIES - 1:
+                raise
+
+            time.sleep(0.5 * 2**attempt)
+
+
+def is_transient_error(error):
+    return frappe.db.is_deadlocked(error) or frappe.db.is_timedout(error)
+
+
+@frappe.whitelist()
+def requeue_dead_letter_statuses():
+    """Move dead-lettered receipts back to the buffer and flush them."""
+    frappe.only_for("System Manager")
+
+    cache = frappe.cache()
+    statuses = cache.lrange(STATUS_DEAD_LETTER_KEY, 0, -1)
+    if not statuses:
+        return 0
+
+    for status in statuses:
+        cache.rpush(STATUS_BUFFER_KEY, status)
+    # receipts dead-lettered meanwhile stay
+    cache.ltrim(STATUS_DEAD_LETTER_KEY, len(statuses), -1)
+
+    frappe.enqueue(flush_statuses, queue="short", enqueue_after_commit=True)
+    return len(statuses)
+
+
+def move_to_dead_letter(batch):
+    """Keep failed receipts for inspection, capped to the latest ones."""
+    cache = frappe.cache()
+    for status in batch:
+        cache.rpush(STATUS_DEAD_LETTER_KEY, status)
+    cache.ltrim(STATUS_DEAD_LETTER_KEY, -DEAD_LETTER_SIZE, -1)
+
+
+def update_message_statuses(statuses):
+    """Update status of sent messages from a batch of receipts.
+
+    Messages are resolved with one query and updated with one UPDATE. The
+    status only moves forward, which is enforced in the UPDATE itself so
+    receipts applied out of order or concurrently cannot downgrade it.
+    """
+    latest = {}
+    for status in statuses:
+        current = latest.get(status["id"])
+        latest[status["id"]] = merge_status(current, status)
+
+    messages = get_messages_by_wamid(
+        latest, fields=("name", "message_id", "status", "conversation_id")
+    )
+
+    updates = {}
+    for message in messages:
+        receipt = latest[message.message_id]
+        status = receipt["status"]
+        if get_rank(status) <= get_rank(message.status):
+            status = None
+
+        conversation = (receipt.get("conversation") or {}).get("id")
+        if conversation == message.conversation_id:
+            conversation = None
+
+        if status or conversation:
+            updates[message.name] = (status, conversation)
+
+    if not updates:
+        return
+
+    if has_doc_event_subscribers("WhatsApp Message"):
+        # keep doc events, notifications and server scripts working
+        for name, (status, conversation) in updates.items():
+            doc = frappe.get_doc("WhatsApp Message", name)
+            if status:
+                doc.status = status
+            if conversation:
+                doc.conversation_id = conversation
+            doc.save(ignore_permissions=True)
+        return
+
+    bulk_update_status(updates)
+
+
+def bulk_update_status(updates):
+    """Apply {name: (status, conversation_id)} with a single UPDATE."""
+    frappe.db.sql(*get_status_update_query(updates, now()))
+
+
+def get_status_update_query(updates, timestamp):
+    """UPDATE statement and values for `bulk_update_status`."""
+    status_cases, conversation_cases, values = [], [], []
+    for name, (status, _conversation) in updates.items():
+        if not status:
+            continue
+        not_below = [s for s in STATUS_RANK if STATUS_RANK[s] >= get_rank(status)]
+        status_cases.append(
+            "WHEN name = %s AND (status IS NULL OR LOWER(status) NOT IN ({})) THEN %s".format(
+                ", ".join(["%s"] * len(not_below))
+            )
+        )
+        values.extend([name, *not_below, status])
+
+    for name, (_status, conversation) in updates.items():
+        if conversation:
+            conversation_cases.append("WHEN name = %s THEN %s")
+            values.extend([name, conversation])
+
+    assignments = []
+    if status_cases:
+        assignments.append(f"status = CASE {' '.join(status_cases)} ELSE status END")
+    if conversation_cases:
+        assignments.append(
+            f"conversation_id = CASE {' '.join(conversation_cases)} ELSE conversation_id END"
+        )
+    assignments.append("modified = %s")
+    values.append(timestamp)
+
+    values.extend(updates)
+    query = """UPDATE `tabWhatsApp Message`
+		SET {}
+		WHERE name IN ({})""".format(
+        ", ".join(assignments), ", ".join(["%s"] * len(updates))
+    )
+    return query, values
+
+
+def merge_status(current, receipt):
+    """Combine two receipts of the same message."""
+    if not current:
+        return receipt
+
+    merged = current
+    if get_rank(receipt["status"]) > get_rank(current["status"]):
+        merged = receipt
+
+    if not merged.get("conversation"):
+        conversation = receipt.get("conversation") or current.get("conversation")
+        if conversation:
+            merged = {**merged, "conversation": conversation}
+
+    return merged
+
+
+def get_rank(status):
+    return STATUS_RANK.get((status or "").lower(), 0)
+
@@ -0,0 +1,230 @@
+"""Outbound queue of WhatsApp Messages, drained under Meta's rate limits.
+
+Messages are saved with status "Queued" and the Graph API payload. A
+background job sends them through a token bucket sized by "Messages per
+Second" in WhatsApp Settings. On a throttling error the drain stops and
+backs off exponentially, leaving the rest of the queue untouched.
+"""
+
+import json
+import time
+
+import frappe
+from frappe.utils import now
+from redis.exceptions import LockError
+
+from frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_settings.whatsapp_settings import (
+    get_whatsapp_settings,
+)
+from frappe_whatsapp.utils.graph_api import GraphAPIError, get_client
+
+# throughput (130429), pair rate (131056), account (80007) and app (4) limits
+THROTTLE_ERROR_CODES = {4, 80007, 130429, 131056}
+
+BATCH_SIZE = 100
+# the job re-enqueues itself instead of holding a worker for too long
+MAX_DRAIN_SECONDS = 240
+MIN_BACKOFF_SECONDS = 30
+MAX_BACKOFF_SECONDS = 15 * 60
+STATS_KEY = "whatsapp_outbound_stats"
+
+# {(site, phone_id): TokenBucket}
+_buckets = {}
+
+
+class TokenBucket:
+    """Allow `rate` acquisitions per second with bursts up to `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def acquire(self):
+        while True:
+            current = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (current - self.updated) * self.rate
+            )
+            self.updated = current
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+
+            time.sleep((1 - self.tokens) / self.rate)
+
+
+def queue_message(data, **fields):
+    """Save a Graph API message payload as a Queued WhatsApp Message."""
+    return frappe.get_doc(
+        {
+            "doctype": "WhatsApp Message",
+            "type": "Outgoing",
+            "to": data["to"],
+            "status": "Queued",
+            "payload": json.dumps(data),
+            **fields,
+        }
+    ).insert(ignore_permissions=True)
+
+
+def enqueue_drain():
+    """Start draining after commit, once per request."""
+    if frappe.flags.whatsapp_drain_enqueued:
+        return
+
+    frappe.flags.whatsapp_drain_enqueued = True
+    frappe.enqueue(drain_outbound_queue, queue="short", enqueue_after_commit=True)
+
+
+def drain_outbound_queue():
+    """Send Queued messages. Also scheduled to resume after backoff."""
+    settings = get_whatsapp_settings()
+    cache = frappe.cache()
+
+    if cache.get_value(get_backoff_key(settings.phone_id)):
+        return
+
+    lock = cache.lock(
+        cache.make_key(f"whatsapp_outbound_drain:{settings.phone_id}"),
+        timeout=MAX_DRAIN_SECONDS * 2,
+    )
+    if not lock.acquire(blocking=False):
+        return
+
+    resume = False
+    try:
+        sent, failed, started = 0, 0, time.monotonic()
+        client = get_client()
+        bucket = get_bucket(settings.phone_id, settings.messages_per_second)
+        stop = False
+
+        while not stop:
+            messages = frappe.get_all(
+                "WhatsApp Message",
+                filters={"type": "Outgoing", "status": "Queued"},
+                fields=["name", "payload"],
+                order_by="creation asc",
+                limit=BATCH_SIZE,
+            )
+            if not messages:
+                break
+
+            for message in messages:
+                # checked per message, a slow batch must stay within the job timeout
+                if time.monotonic() - started > MAX_DRAIN_SECONDS:
+                    resume = stop = True
+                    break
+
+                bucket.acquire()
+                try:
+                    response = client.send_message(json.loads(message.payload))
+                    message_id = response["messages"][0]["id"]
+                except GraphAPIError as e:
+                    if e.code in THROTTLE_ERROR_CODES:
+                        back_off(settings.phone_id)
+                        stop = True
+                        break
+
+                    mark_failed(message.name, e)
+                    failed += 1
+                except Exception as e:
+                    # bad payload or unexpected response, retrying cannot help
+                    # and would stop the drain on this row every time
+                    frappe.log_error(title="WA Outbound Message Failed")
+                    mark_failed(message.name, e)
+                    failed += 1
+                else:
+                    frappe.db.set_value(
+                        "WhatsApp Message",
+                        message.name,
+                        {"status": "Success", "message_id": message_id},
+                    )
+                    sent += 1
+
+                # commit per message, so a crash between a send and its
+                # commit resends at most that one message
+                frappe.db.commit()
+
+        if sent:
+            cache.delete_value(get_backoff_attempts_key(settings.phone_id))
+        record_stats(sent, failed, time.monotonic() - started)
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            # expired while a slow send ran
+            pass
+
+    if resume:
+        # continue in a fresh job instead of holding this worker
+        frappe.enqueue(drain_outbound_queue, queue="short")
+
+
+def mark_failed(name, error):
+    meta_data = getattr(error, "data", None) or {"error": {"message": str(error)}}
+    frappe.db.set_value("WhatsApp Message", name, "status", "Failed")
+    frappe.get_doc(
+        {
+            "doctype": "WhatsApp Notification Log",
+            "template": "Text Message",
+            "meta_data": meta_data,
+        }
+    ).insert(ignore_permissions=True)
+
+
+def back_off(phone_id):
+    """Pause draining for this phone number, doubling on each throttle."""
+    cache = frappe.cache()
+    attempts = (cache.get_value(get_backoff_attempts_key(phone_id)) or 0) + 1
+    cache.set_value(get_backoff_attempts_key(phone_id), attempts)
+
+    seconds = min(MIN_BACKOFF_SECONDS * 2 ** (attempts - 1), MAX_BACKOFF_SECONDS)
+    cache.set_value(get_backoff_key(phone_id), 1, expires_in_sec=seconds)
+
+
+def get_bucket(phone_id, rate):
+    rate = rate or 20
+    key = (frappe.local.site, phone_id)
+    bucket = _buckets.get(key)
+    if not bucket or bucket.rate != rate:
+        bucket = _buckets[key] = TokenBucket(rate)
+
+    return bucket
+
+
+def get_backoff_key(phone_id):
+    return f"whatsapp_outbound_backoff:{phone_id}"
+
+
+def get_backoff_attempts_key(phone_id):
+    return f"whatsapp_outbound_backoff_attempts:{phone_id}"
+
+
+def record_stats(sent, failed, seconds):
+    frappe.cache().set_value(
+        STATS_KEY,
+        {
+            "sent": sent,
+            "failed": failed,
+            "seconds": round(seconds, 2),
+            "rate": round(sent / seconds, 2) if seconds else 0,
+            "finished_at": now(),
+        },
+    )
+
+
+@frappe.whitelist()
+def get_outbound_queue_stats():
+    """Queue depth, backoff state and throughput of the last drain."""
+    frappe.only_for("System Manager")
+
+    phone_id = get_whatsapp_settings().phone_id
+    return {
+        "queued": frappe.db.count(
+            "WhatsApp Message", {"type": "Outgoing", "status": "Queued"}
+        ),
+        "backing_off": bool(frappe.cache().get_value(get_backoff_key(phone_id))),
+        "last_drain": frappe.cache().get_value(STATS_KEY),
+    }
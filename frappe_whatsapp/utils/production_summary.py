@@ -0,0 +1,123 @@
+"""Monthly production per site and mining item, read by the chatbot.
+
+WhatsApp Production Summary rows are adjusted when a Site Daily Production
+Entry is submitted or cancelled, so production replies read at most twelve
+rows per item instead of aggregating the year's detail rows. The table can
+be rebuilt from the entries with `bench rebuild-whatsapp-production-summary`.
+"""
+
+import hashlib
+
+import frappe
+from frappe.query_builder.functions import Extract, Sum
+from frappe.utils import flt, getdate, now
+
+from frappe_whatsapp.utils.report_cache import clear_site_report_cache
+
+SUMMARY_DOCTYPE = "WhatsApp Production Summary"
+
+
+def update_production_summary(doc, method=None):
+    """Add the entry's tonnage on submit, subtract it on cancel."""
+    sign = -1 if doc.docstatus == 2 else 1
+    posting_date = getdate(doc.posting_date)
+
+    rows = frappe.db.sql(
+        """SELECT mining_item_code, SUM(tonnage_by_tf)
+		FROM `tabSite Daily Production Entry Detail`
+		WHERE parent = %s AND parenttype = 'Site Daily Production Entry'
+		GROUP BY mining_item_code""",
+        doc.name,
+    )
+    upsert_summary(
+        [
+            (doc.site_name, item, posting_date.year, posting_date.month, sign * flt(tonnage))
+            for item, tonnage in rows
+        ]
+    )
+
+
+def upsert_summary(rows, replace=False):
+    """Write (site, item, year, month, tonnage) rows.
+
+    The tonnage is added to existing rows in the same statement, so
+    concurrent submits of one site and month cannot lose an update. Rows
+    are matched on the unique (site, item, year, month) index.
+    """
+    if not rows:
+        return
+
+    timestamp, user = now(), frappe.session.user
+    values = []
+    for site_name, item, year, month, tonnage in rows:
+        name = get_summary_name(site_name, item, year, month)
+        values.extend([name, timestamp, timestamp, user, user, site_name, item, year, month, tonnage])
+
+    tonnage = "VALUES(tonnage)" if replace else "tonnage + VALUES(tonnage)"
+    frappe.db.sql(
+        """INSERT INTO `tabWhatsApp Production Summary`
+		(name, creation, modified, owner, modified_by,
+		site_name, mining_item_code, year, month, tonnage)
+		VALUES {}
+		ON DUPLICATE KEY UPDATE tonnage = {}, modified = VALUES(modified)""".format(
+            ", ".join(["(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"] * len(rows)), tonnage
+        ),
+        values,
+    )
+
+
+def get_summary_name(site_name, item, year, month):
+    """Name derived from the whole key, names may contain hyphens."""
+    key = "\x1f".join(str(part) for part in (site_name, item, year, month))
+    return hashlib.sha1(key.encode()).hexdigest()[:20]
+
+
+def rebuild_production_summary(year=None):
+    """Recompute the summary, of one year or of all, from submitted entries."""
+    prod = frappe.qb.DocType("Site Daily Production Entry")
+    prod_detail = frappe.qb.DocType("Site Daily Production Entry Detail")
+
+    query = (
+        frappe.qb.select(
+            prod.site_name,
+            prod_detail.mining_item_code,
+            Extract("year", prod.posting_date).as_("year"),
+            Extract("month", prod.posting_date).as_("month"),
+            Sum(prod_detail.tonnage_by_tf).as_("tonnage"),
+        )
+        .from_(prod_detail)
+        .join(prod)
+        .on(prod.name == prod_detail.parent)
+        .where(prod.docstatus == 1)
+        .groupby(
+            prod.site_name,
+            prod_detail.mining_item_code,
+            Extract("year", prod.posting_date),
+            Extract("month", prod.posting_date),
+        )
+    )
+    delete_filters = {}
+    if year:
+        query = query.where(prod.posting_date.between(f"{year}-01-01", f"{year}-12-31"))
+        delete_filters["year"] = year
+
+    rows = query.run()
+    frappe.db.delete(SUMMARY_DOCTYPE, delete_filters)
+    upsert_summary(
+        [(site_name, item, y, m, flt(tonnage)) for site_name, item, y, m, tonnage in rows],
+        replace=True,
+    )
+
+    for site_name in {row[0] for row in rows}:
+        clear_site_report_cache(site_name)
+
+    return len(rows)
+
+
+def get_production_summary(site_name, year):
+    """Tonnage by mining item and month of a site's year."""
+    return frappe.get_all(
+        SUMMARY_DOCTYPE,
+        filters={"site_name": site_name, "year": year},
+        fields=["mining_item_code", "month", "tonnage"],
+    )
@@ -0,0 +1,46 @@
+"""Short-lived cache of chatbot report answers, keyed by site and year.
+
+Entries are dropped when production or stockpile documents of the site are
+submitted or cancelled, the TTL only bounds staleness from other changes.
+"""
+
+import frappe
+
+REPORT_CACHE_EXPIRY = 10 * 60
+
+
+def get_cached_report(report, filters, generator):
+    """Return `generator(filters)`, cached for the filters' site and year."""
+    site_name, year = filters.get("site_name"), filters.get("year")
+    cache = frappe.cache()
+    version = cache.get_value(_version_key(site_name)) or 0
+    key = f"whatsapp_report:{report}:{site_name}:{year}:{version}"
+
+    value = cache.get_value(key)
+    if value is None:
+        value = generator(filters)
+        cache.set_value(key, value, expires_in_sec=REPORT_CACHE_EXPIRY)
+
+    return value
+
+
+def clear_report_cache(doc, method=None):
+    """Drop cached reports of the document's site.
+
+    Stockpile balances carry over between years, so every year of the site
+    is dropped, not only the year of the document.
+    """
+    clear_site_report_cache(doc.get("site_name"))
+
+
+def clear_site_report_cache(site_name):
+    _clear(site_name)
+    frappe.db.after_commit.add(lambda: _clear(site_name))
+
+
+def _clear(site_name):
+    frappe.cache().set_value(_version_key(site_name), frappe.generate_hash(length=10))
+
+
+def _version_key(site_name):
+    return f"whatsapp_report_version:{site_name}"
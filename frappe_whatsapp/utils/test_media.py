@@ -0,0 +1,61 @@
+# Copyright (c) 2026, Shridhar Patil and Contributors
+# See license.txt
+
+import hashlib
+from unittest.mock import MagicMock, patch
+
+import frappe
+from frappe.tests import IntegrationTestCase
+
+from frappe_whatsapp.utils.media import download_media
+
+CONTENT = b"forwarded voice note"
+SHA256 = hashlib.sha256(CONTENT).hexdigest()
+
+
+def get_message():
+    return frappe.get_doc(
+        {
+            "doctype": "WhatsApp Message",
+            "type": "Incoming",
+            "from": "15550001111",
+            "message": "",
+            "content_type": "audio",
+        }
+    ).insert(ignore_permissions=True)
+
+
+class TestMediaDownload(IntegrationTestCase):
+    def test_same_media_is_stored_once(self):
+        client = MagicMock()
+        client.get.side_effect = lambda path: {
+            "url": f"https://lookaside.example/{path}",
+            "mime_type": "audio/ogg; codecs=opus",
+            "file_size": len(CONTENT),
+            "sha256": SHA256,
+        }
+        client.raw_request.return_value.iter_content.return_value = [CONTENT]
+
+        messages = [get_message(), get_message()]
+        with patch("frappe_whatsapp.utils.media.get_client", return_value=client):
+            for i, message in enumerate(messages):
+                download_media(message.name, f"_test_media_{i}_{frappe.generate_hash()}")
+
+        # the second delivery is served from the stored file
+        self.assertEqual(client.raw_request.call_count, 1)
+
+        files = frappe.get_all(
+            "File",
+            filters={
+                "attached_to_doctype": "WhatsApp Message",
+                "attached_to_name": ("in", [message.name for message in messages]),
+            },
+            fields=["file_url", "file_size"],
+        )
+        self.assertEqual(len(files), 2)
+        self.assertEqual({file.file_url for file in files}, {f"/private/files/{SHA256}.ogg"})
+        self.assertEqual({file.file_size for file in files}, {len(CONTENT)})
+
+        for message in messages:
+            message.reload()
+            self.assertEqual(message.attach, f"/private/files/{SHA256}.ogg")
@@ -0,0 +1,68 @@
+# Copyright (c) 2026, Shridhar Patil and Contributors
+# See license.txt
+
+import json
+from unittest.mock import MagicMock, patch
+
+from frappe.tests import UnitTestCase
+
+from frappe_whatsapp.utils.message_status import (
+    apply_statuses,
+    get_rank,
+    get_status_update_query,
+    merge_status,
+)
+
+
+class TestMessageStatus(UnitTestCase):
+    def test_merge_keeps_highest_status(self):
+        sent = {"id": "wamid.1", "status": "sent", "conversation": {"id": "c1"}}
+        read = {"id": "wamid.1", "status": "read"}
+        delivered = {"id": "wamid.1", "status": "delivered"}
+
+        merged = merge_status(merge_status(merge_status(None, sent), read), delivered)
+        self.assertEqual(merged["status"], "read")
+        # conversation of an earlier receipt is kept
+        self.assertEqual(merged["conversation"], {"id": "c1"})
+
+    def test_failed_wins(self):
+        merged = merge_status(
+            {"id": "wamid.1", "status": "read"}, {"id": "wamid.1", "status": "failed"}
+        )
+        self.assertEqual(merged["status"], "failed")
+
+    def test_rank(self):
+        self.assertEqual(get_rank(None), 0)
+        self.assertEqual(get_rank("Success"), 0)
+        self.assertLess(get_rank("Sent"), get_rank("delivered"))
+
+    def test_update_query_never_downgrades(self):
+        query, values = get_status_update_query(
+            {"m1": ("delivered", None), "m2": (None, "c2")}, "2026-01-01 00:00:00"
+        )
+
+        self.assertEqual(query.count("%s"), len(values))
+        # delivered only applies over statuses ranked below it
+        self.assertEqual(values[:5], ["m1", "delivered", "read", "failed", "delivered"])
+        self.assertEqual(values[5:7], ["m2", "c2"])
+        self.assertEqual(values[-2:], ["m1", "m2"])
+
+    def test_only_failing_receipts_are_dead_lettered(self):
+        batch = [json.dumps({"id": f"wamid.{i}", "status": "read"}) for i in range(8)]
+
+        def update(statuses):
+            if any(status["id"] == "wamid.5" for status in statuses):
+                raise ValueError("bad receipt")
+
+        db = MagicMock()
+        db.is_deadlocked.return_value = db.is_timedout.return_value = False
+        module = "frappe_whatsapp.utils.message_status"
+        with (
+            patch(f"{module}.frappe.db", db),
+            patch(f"{module}.frappe.log_error"),
+            patch(f"{module}.update_message_statuses", side_effect=update),
+            patch(f"{module}.move_to_dead_letter") as move_to_dead_letter,
+        ):
+            apply_statuses(batch)
+
+        move_to_dead_letter.assert_called_once_with([batch[5]])
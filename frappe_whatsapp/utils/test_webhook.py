@@ -0,0 +1,21 @@
+# Copyright (c) 2026, Shridhar Patil and Contributors
+# See license.txt
+
+import frappe
+from frappe.tests import IntegrationTestCase
+
+from frappe_whatsapp.install import add_production_indexes
+from frappe_whatsapp.utils.webhook import get_last_production_query
+
+
+class TestProductionQueries(IntegrationTestCase):
+    def test_last_production_uses_index(self):
+        add_production_indexes()
+        query = get_last_production_query(
+            frappe._dict({"site_name": "_Test Site", "year": "2025"})
+        )
+
+        plan = frappe.db.sql(f"EXPLAIN {query}", as_dict=True)[0]
+        self.assertIn("docstatus_site_posting_index", plan.possible_keys or "")
+        self.assertNotIn("filesort", plan.Extra or "")
+        self.assertNotIn("EXTRACT", str(query).upper())
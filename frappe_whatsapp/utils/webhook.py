@@ -7,22 +7,43 @@ import time
 import frappe
 from frappe import _
 import requests
-from frappe.integrations.utils import make_post_request
 from frappe.query_builder import Order
-from frappe.query_builder.functions import CombineDatetime, Extract, Sum
 from frappe.utils import (
     TypedDict,
+    add_to_date,
+    cint,
     cstr,
     flt,
     get_link_to_form,
     get_time,
     getdate,
+    now_datetime,
     nowdate,
     nowtime,
 )
+from frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_message.whatsapp_message import (
+    get_message_by_wamid,
+)
+from frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_settings.whatsapp_settings import (
+    get_whatsapp_settings,
+)
+from frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_templates.whatsapp_templates import (
+    clear_template_cache,
+)
+from frappe_whatsapp.utils.graph_api import GraphAPIError, get_client
+from frappe_whatsapp.utils.intents import route_text_message
+from frappe_whatsapp.utils.media import enqueue_media_download
+from frappe_whatsapp.utils.production_summary import get_production_summary
+from frappe_whatsapp.utils.report_cache import get_cached_report
+from frappe_whatsapp.utils.message_status import queue_statuses
 from hcapp.mine_production.api.v1.get_stockpile_balance import get_stockpile_balance
 from werkzeug.wrappers import Response
 
+WEBHOOK_EVENT_SAVEPOINT = "whatsapp_webhook_event"
+# Queued payloads older than this lost their job and are enqueued again
+STALE_WEBHOOK_MINUTES = 15
+WEBHOOK_SWEEP_LIMIT = 500
+
 
 @frappe.whitelist(allow_guest=True)
 def webhook():
@@ -35,9 +56,7 @@ def webhook():
 def get():
     """Get."""
     hub_challenge = frappe.form_dict.get("hub.challenge")
-    webhook_verify_token = frappe.db.get_single_value(
-        "WhatsApp Settings", "webhook_verify_token"
-    )
+    webhook_verify_token = get_whatsapp_settings().webhook_verify_token
 
     if frappe.form_dict.get("hub.verify_token") != webhook_verify_token:
         frappe.throw("Verify token does not match")
@@ -64,7 +83,7 @@ def get_n8n_settings():
 
 def is_duplicate_request(wamid):
     # Gunakan wamid sebagai key unik di cache
-    cache_key = f"ws_msg_{wamid}"
+    cache_key = get_duplicate_request_key(wamid)
     
     # Cek apakah key sudah ada di Redis
     if frappe.cache().get_value(cache_key):
@@ -73,7 +92,17 @@ def is_duplicate_request(wamid):
     # Simpan key ke Redis dengan masa berlaku (TTL) 600 detik (10 menit)
     # Ini cukup untuk menahan retry otomatis dari WhatsApp
     frappe.cache().set_value(cache_key, 1, expires_in_sec=600)
-    return False
+
+    # retry setelah TTL habis, cek pesan yang sudah tersimpan (index message_id)
+    return bool(get_message_by_wamid(wamid))
+
+
+def release_duplicate_request(wamid):
+    frappe.cache().delete_value(get_duplicate_request_key(wamid))
+
+
+def get_duplicate_request_key(wamid):
+    return f"ws_msg_{wamid}"
 
 
 # def get_whatsapp_media(media_id):
@@ -139,7 +168,20 @@ def post():
         frappe.log_error(_("Payload not found"))
         return
     
-    data = json.loads(payload)
+    try:
+        data = json.loads(payload)
+    except ValueError:
+        frappe.log_error(title="WA Invalid Payload", message=cstr(payload))
+        return
+
+    if not isinstance(data, dict) or not data.get("entry"):
+        frappe.log_error(title="WA Invalid Payload", message=cstr(payload))
+        return
+
+    settings = get_whatsapp_settings()
+    if cint(settings.process_webhook_in_background):
+        enqueue_payload(data, queue=settings.webhook_queue)
+        return "OK"
 
     frappe.get_doc(
         {
@@ -151,185 +193,317 @@ def post():
 
     frappe.log_error(title="WA Payload Incoming", message=frappe.as_json(data))
 
-    messages = []
-    
+    return process_payload(data)
+
+
+def enqueue_payload(data, queue=None):
+    """Store payload with a single insert and process it in background."""
+    log = frappe.get_doc(
+        {
+            "doctype": "WhatsApp Notification Log",
+            "template": "Webhook",
+            "meta_data": json.dumps(data),
+            "status": "Queued",
+        }
+    )
+    # db_insert skips validation and doc event hooks
+    log.db_insert()
+
+    enqueue_webhook_log(log.name, queue, enqueue_after_commit=True)
+
+
+def enqueue_webhook_log(log_name, queue=None, enqueue_after_commit=False):
+    """Enqueue processing of a stored payload, unless its job is still waiting.
+
+    The job id is stable per log, so a sweep during a long backlog does not
+    pile duplicate jobs behind the original one.
+    """
+    frappe.enqueue(
+        process_webhook_log,
+        queue=queue or "short",
+        job_id=f"whatsapp_webhook_log::{log_name}",
+        deduplicate=True,
+        enqueue_after_commit=enqueue_after_commit,
+        log_name=log_name,
+    )
+
+
+def process_webhook_log(log_name):
+    """Process a stored webhook payload."""
+    # row lock, a payload re-enqueued by the sweep is never run twice at once
+    log = frappe.db.get_value(
+        "WhatsApp Notification Log",
+        log_name,
+        ["meta_data", "status"],
+        as_dict=True,
+        for_update=True,
+    )
+    if not log or log.status != "Queued" or not log.meta_data:
+        return
+
     try:
-        messages = data["entry"][0]["changes"][0]["value"].get("messages", [])
-        wamid = data['entry'][0]['changes'][0]['value']['messages'][0]['id']
-        
-        if is_duplicate_request(wamid):
-            return "OK (Duplicate Ignored)"
-    
-    except KeyError:
-        messages = data["entry"]["changes"][0]["value"].get("messages", [])
-        pass
-
-
-    if messages:
-        for message in messages:
-            message_type = message["type"]
-            is_reply = True if message.get("context") else False
-            reply_to_message_id = message["context"]["id"] if is_reply else None
-  
-            if message_type == "text":
-                message_body = message["text"]["body"]
-                save_incoming_message(message, message_type, message_body, reply_to_message_id, is_reply)
-           
-                sender = message["from"]
-                text = message_body
-
-                msg = ""
-                
-                user_input = text or ""
-                clean_text = user_input.replace(" ", "").lower()
-
-                if clean_text in ["in", "checkin", "out", "checkout", "masuk", "pulang"]:
-                    frappe.enqueue(
-                        post_payload_to_n8n_webhook,
-                        payload=data,
-                        queue='long', # Gunakan antrean 'long' untuk proses yang melibatkan network request
-                        timeout=300
-                    )
-                    return "OK"
-
-                elif text.lower() == "hello":
-                    msg = "Hi there! How can I help you?"
-                    send_response(sender, msg)
-                
-                else:
-                    filtered_text = filter_text_message(text)
-                    if filtered_text:
-                        keyword = filtered_text["keyword"]
-                        filters = frappe._dict(
-                            {
-                                "site_name": filtered_text["site_name"],
-                                "year": filtered_text["year"],
-                            }
-                        )
-                        if keyword.lower() == "production":
-                            prod = get_yearly_production_data(filters)
-                            if prod:
-                                prod_last_update = frappe.utils.format_datetime(
-                                    prod.last_posting_date, "d MMM yyyy H:m"
-                                )
-
-                                msg = f"Total produksi (_update {prod_last_update}_)\n"
-                                for key, val in prod.prod_data.items():
-                                    tonnage = frappe.utils.fmt_money(val["tonnage"], 2)
-                                    msg += f"- {key} = *{tonnage}* {val['uom']}\n"
-                            else:
-                                msg = "Production data is not available"
-                        elif keyword.lower() == "stockpile":
-                            sbal = get_stockpile_balance_report(filters)
-                            if sbal:
-                                last_update = frappe.utils.format_datetime(
-                                    sbal["last_update"], "d MMM yyyy H:m"
-                                )
-                                msg = f"Stockpile balance (_update {last_update}_)\n"
-                                for sb in sbal["balance"]:
-                                    msg += f"- {sb} = "
-                                    for dt in sbal["balance"][sb]:
-                                        qty_survey = frappe.utils.fmt_money(
-                                            sbal["balance"][sb][dt]["qty_by_survey"], 2
-                                        )
-                                        msg += f"*{qty_survey}* {sbal['balance'][sb][dt]['uom']}\n"
-                            else:
-                                msg = "Stobkpile balance data is not available"
-                        else:
-                            msg = "Please type your keyword with correct format (eg: 'production ptp 2025' or 'stockpile ptp 2025')"
-                    else:
-                        msg = "Please type your keyword with correct format (eg: 'production ptp 2025' or 'stockpile ptp 2025')"
-
-                    send_response(sender, msg)
-
-            elif message_type == "location":
-                try:    
-                    latitude = message["location"]["latitude"]
-                    longitude = message["location"]["longitude"]
-                    message_body = f"Latitude: {latitude}, Longitude: {longitude}"
-
-                    save_incoming_message(message, message_type, message_body, reply_to_message_id, is_reply)
-                    
-                    frappe.enqueue(
-                        post_payload_to_n8n_webhook,
-                        payload=data,
-                        queue='long', # Gunakan antrean 'long' untuk proses yang melibatkan network request
-                        timeout=300
-                    )
-                    return "OK"
-                except Exception as e:
-                    frappe.log_error(f"Error pada location: {str(e)}", "Webhook Error")
-
-            elif message_type == "reaction":
-                save_incoming_message(message, message_type, reply_to_message_id, is_reply)      
-
-            elif message_type == "interactive":
-                save_incoming_message(message, message_type, reply_to_message_id, is_reply)
-
-            elif message_type in ["image", "audio", "video", "document"]:
-                settings = frappe.get_doc(
-                    "WhatsApp Settings",
-                    "WhatsApp Settings",
+        process_payload(json.loads(log.meta_data))
+        status = "Processed"
+    except Exception:
+        frappe.db.rollback()
+        frappe.log_error(title="WA Webhook Processing Failed")
+        status = "Failed"
+
+    frappe.db.set_value(
+        "WhatsApp Notification Log", log_name, "status", status, update_modified=False
+    )
+
+
+def requeue_stale_webhooks():
+    """Re-enqueue Queued payloads whose job was lost, e.g. on a Redis restart."""
+    settings = get_whatsapp_settings()
+    if not cint(settings.process_webhook_in_background):
+        return
+
+    names = frappe.get_all(
+        "WhatsApp Notification Log",
+        filters={
+            "template": "Webhook",
+            "status": "Queued",
+            "creation": ("<", add_to_date(now_datetime(), minutes=-STALE_WEBHOOK_MINUTES)),
+        },
+        pluck="name",
+        order_by="creation asc",
+        limit=WEBHOOK_SWEEP_LIMIT,
+    )
+    for name in names:
+        enqueue_webhook_log(name, settings.webhook_queue)
+
+
+@frappe.whitelist()
+def retry_failed_webhooks(log_names=None):
+    """Queue Failed payloads, all or the given ones, for processing again."""
+    frappe.only_for("System Manager")
+
+    filters = {"template": "Webhook", "status": "Failed"}
+    if log_names:
+        filters["name"] = ("in", frappe.parse_json(log_names))
+
+    names = frappe.get_all("WhatsApp Notification Log", filters=filters, pluck="name")
+    queue = get_whatsapp_settings().webhook_queue
+    for name in names:
+        frappe.db.set_value(
+            "WhatsApp Notification Log", name, "status", "Queued", update_modified=False
+        )
+        enqueue_webhook_log(name, queue, enqueue_after_commit=True)
+
+    return len(names)
+
+
+@frappe.whitelist()
+def get_webhook_backlog():
+    """Pending webhook payloads and background queue length."""
+    from frappe.utils.background_jobs import get_queue
+
+    frappe.only_for("System Manager")
+
+    queue = get_whatsapp_settings().webhook_queue or "short"
+    counts = dict(
+        frappe.get_all(
+            "WhatsApp Notification Log",
+            filters={"template": "Webhook", "status": ("in", ("Queued", "Failed"))},
+            fields=["status", "count(name) as count"],
+            group_by="status",
+            as_list=True,
+        )
+    )
+
+    return {
+        "queued": counts.get("Queued", 0),
+        "failed": counts.get("Failed", 0),
+        "queue": queue,
+        "queue_length": get_queue(queue).count,
+    }
+
+
+def process_payload(data):
+    """Handle messages and status updates of a webhook payload.
+
+    Each message runs in its own savepoint, so one failing reply or save
+    is logged and rolled back without dropping the rest of the delivery.
+    """
+    statuses = []
+    try:
+        for kind, item, change, entry in iter_webhook_events(data):
+            if kind == "status":
+                statuses.append(item)
+                continue
+
+            if kind == "message" and is_duplicate_request(item["id"]):
+                continue
+
+            frappe.db.savepoint(WEBHOOK_EVENT_SAVEPOINT)
+            try:
+                if kind == "message":
+                    handle_message(item, get_message_payload(data, entry, change, item))
+                elif kind == "message_template_status_update":
+                    update_template_status(item)
+            except Exception:
+                frappe.db.rollback(save_point=WEBHOOK_EVENT_SAVEPOINT)
+                if kind == "message":
+                    # let a retry of the delivery handle it again
+                    release_duplicate_request(item["id"])
+                frappe.log_error(
+                    title="WA Webhook Event Failed", message=frappe.get_traceback()
                 )
-                token = settings.get_password("token")
-                url = f"{settings.url}/{settings.version}/"
-
-                media_id = message[message_type]["id"]
-                headers = {"Authorization": "Bearer " + token}
-                response = requests.get(f"{url}{media_id}/", headers=headers)
-
-                if response.status_code == 200:
-                    media_data = response.json()
-                    media_url = media_data.get("url")
-                    mime_type = media_data.get("mime_type")
-                    file_extension = mime_type.split("/")[1]
-
-                    media_response = requests.get(media_url, headers=headers)
-                    if media_response.status_code == 200:
-                        file_data = media_response.content
-                        file_name = (
-                            f"{frappe.generate_hash(length=10)}.{file_extension}"
-                        )
-                         
-                        message_doc = save_incoming_media_message(message, message_type, reply_to_message_id, is_reply, file_name)
-
-                        file = frappe.get_doc(
-                            {
-                                "doctype": "File",
-                                "file_name": file_name,
-                                "attached_to_doctype": "WhatsApp Message",
-                                "attached_to_name": message_doc.name,
-                                "content": file_data,
-                                "attached_to_field": "attach",
-                            }
-                        ).save(ignore_permissions=True)
-
-                        message_doc.attach = file.file_url
-                        message_doc.save()
-
-            elif message_type == "button":
-                save_incoming_message(message, message_type, reply_to_message_id, is_reply)  
-            
+    finally:
+        queue_statuses(statuses)
+
+
+def iter_webhook_events(data):
+    """Yield (kind, item, change, entry) for every message, status and change.
+
+    Meta batches several entries per delivery, each with several changes,
+    and a `messages` change may carry several messages and statuses. Kind
+    is "message", "status" or, for other changes, the change's field.
+    """
+    entries = data.get("entry") or []
+    if isinstance(entries, dict):
+        entries = [entries]
+
+    for entry in entries:
+        for change in entry.get("changes") or []:
+            field = change.get("field")
+            value = change.get("value") or {}
+            if field == "messages":
+                for message in value.get("messages") or []:
+                    yield "message", message, change, entry
+                for status in value.get("statuses") or []:
+                    yield "status", status, change, entry
             else:
-                frappe.get_doc(
-                    {
-                        "doctype": "WhatsApp Message",
-                        "type": "Incoming",
-                        "from": message["from"],
-                        "message_id": message["id"],
-                        "message": message[message_type].get(message_type),
-                        "content_type": message_type,
-                    }
-                ).insert(ignore_permissions=True)
+                yield field, value, change, entry
+
+
+def get_message_payload(data, entry, change, message):
+    """Payload in webhook format containing only `message`."""
+    return {
+        **data,
+        "entry": [
+            {
+                **entry,
+                "changes": [
+                    {**change, "value": {**change["value"], "messages": [message]}}
+                ],
+            }
+        ],
+    }
+
+
+def handle_message(message, data):
+    """Save incoming message and reply to bot keywords."""
+    message_type = message["type"]
+    is_reply = True if message.get("context") else False
+    reply_to_message_id = message["context"]["id"] if is_reply else None
+
+    if message_type == "text":
+        message_body = message["text"]["body"]
+        save_incoming_message(message, message_type, message_body, reply_to_message_id, is_reply)
 
+        msg = route_text_message(message, data)
+        if msg:
+            send_response(message["from"], msg)
+
+    elif message_type == "location":
+        try:    
+            latitude = message["location"]["latitude"]
+            longitude = message["location"]["longitude"]
+            message_body = f"Latitude: {latitude}, Longitude: {longitude}"
+
+            save_incoming_message(message, message_type, message_body, reply_to_message_id, is_reply)
+            
+            frappe.enqueue(
+                post_payload_to_n8n_webhook,
+                payload=data,
+                queue='long', # Gunakan antrean 'long' untuk proses yang melibatkan network request
+                timeout=300
+            )
+            return "OK"
+        except Exception as e:
+            frappe.log_error(f"Error pada location: {str(e)}", "Webhook Error")
+
+    elif message_type == "reaction":
+        save_incoming_message(message, message_type, reply_to_message_id, is_reply)      
+
+    elif message_type == "interactive":
+        save_incoming_message(message, message_type, reply_to_message_id, is_reply)
+
+    elif message_type in ["image", "audio", "video", "document"]:
+        message_doc = save_incoming_media_message(message, message_type, reply_to_message_id, is_reply)
+        enqueue_media_download(message_doc.name, message[message_type]["id"])
+
+    elif message_type == "button":
+        save_incoming_message(message, message_type, reply_to_message_id, is_reply)  
+    
     else:
-        changes = None
-        try:
-            changes = data["entry"][0]["changes"][0]
-        except KeyError:
-            changes = data["entry"]["changes"][0]
-        update_status(changes)
-    return
+        frappe.get_doc(
+            {
+                "doctype": "WhatsApp Message",
+                "type": "Incoming",
+                "from": message["from"],
+                "message_id": message["id"],
+                "message": message[message_type].get(message_type),
+                "content_type": message_type,
+            }
+        ).insert(ignore_permissions=True)
+
+
+def forward_to_n8n(context):
+    """Check-in/out keywords are handled by the n8n attendance flow."""
+    frappe.enqueue(
+        post_payload_to_n8n_webhook,
+        payload=context.data,
+        queue='long', # Gunakan antrean 'long' untuk proses yang melibatkan network request
+        timeout=300
+    )
+
+
+def reply_hello(context):
+    return "Hi there! How can I help you?"
+
+
+def reply_production(context):
+    filters = frappe._dict({"site_name": context.site_name, "year": context.year})
+    prod = get_yearly_production_data(filters)
+    if not prod:
+        return "Production data is not available"
+
+    prod_last_update = frappe.utils.format_datetime(
+        prod.last_posting_date, "d MMM yyyy H:m"
+    )
+
+    msg = f"Total produksi (_update {prod_last_update}_)\n"
+    for key, val in prod.prod_data.items():
+        tonnage = frappe.utils.fmt_money(val["tonnage"], 2)
+        msg += f"- {key} = *{tonnage}* {val['uom']}\n"
+
+    return msg
+
+
+def reply_stockpile(context):
+    filters = frappe._dict({"site_name": context.site_name, "year": context.year})
+    sbal = get_stockpile_balance_report(filters)
+    if not sbal:
+        return "Stobkpile balance data is not available"
+
+    last_update = frappe.utils.format_datetime(
+        sbal["last_update"], "d MMM yyyy H:m"
+    )
+    msg = f"Stockpile balance (_update {last_update}_)\n"
+    for sb in sbal["balance"]:
+        msg += f"- {sb} = "
+        for dt in sbal["balance"][sb]:
+            qty_survey = frappe.utils.fmt_money(
+                sbal["balance"][sb][dt]["qty_by_survey"], 2
+            )
+            msg += f"*{qty_survey}* {sbal['balance'][sb][dt]['uom']}\n"
+
+    return msg
+
 
 def save_incoming_message(message, message_type, message_body=None, reply_to_message_id=None, is_reply=None):
     return frappe.get_doc(
@@ -345,7 +519,7 @@ def save_incoming_message(message, message_type, message_body=None, reply_to_mes
         }
     ).insert(ignore_permissions=True)
 
-def save_incoming_media_message(message, message_type, reply_to_message_id=None, is_reply=None, file_name=None):
+def save_incoming_media_message(message, message_type, reply_to_message_id=None, is_reply=None):
     return frappe.get_doc(
         {
             "doctype": "WhatsApp Message",
@@ -354,26 +528,14 @@ def save_incoming_media_message(message, message_type, reply_to_message_id=None,
             "message_id": message["id"],
             "reply_to_message_id": reply_to_message_id,
             "is_reply": is_reply,
-            "message": message[message_type].get(
-                "caption", f"/files/{file_name}"
-            ),
+            # without a caption the file url is set once downloaded
+            "message": message[message_type].get("caption"),
             "content_type": message_type,
         }
     ).insert(ignore_permissions=True)
 
 def send_response(receiver, message):
     """Notify."""
-    settings = frappe.get_doc(
-        "WhatsApp Settings",
-        "WhatsApp Settings",
-    )
-    token = settings.get_password("token")
-
-    headers = {
-        "authorization": f"Bearer {token}",
-        "content-type": "application/json",
-    }
-
     data = {
         "messaging_product": "whatsapp",
         "to": receiver,
@@ -382,35 +544,20 @@ def send_response(receiver, message):
     }
 
     try:
-        response = make_post_request(
-            f"{settings.url}/{settings.version}/{settings.phone_id}/messages",
-            headers=headers,
-            data=json.dumps(data),
-        )
+        response = get_client().send_message(data)
         message_id = response["messages"][0]["id"]
         print(f"Message id: {message_id}")
 
-    except Exception as e:
-        res = frappe.flags.integration_request.json()["error"]
-        error_message = res.get("Error", res.get("message"))
+    except GraphAPIError as e:
         frappe.get_doc(
             {
                 "doctype": "WhatsApp Notification Log",
                 "template": "Text Message",
-                "meta_data": frappe.flags.integration_request.json(),
+                "meta_data": e.data,
             }
         ).insert(ignore_permissions=True)
 
-        frappe.throw(msg=error_message, title=res.get("error_user_title", "Error"))
-
-
-def update_status(data):
-    """Update status hook."""
-    if data.get("field") == "message_template_status_update":
-        update_template_status(data["value"])
-
-    elif data.get("field") == "messages":
-        update_message_status(data["value"])
+        frappe.throw(msg=e.message, title=e.title or "Error")
 
 
 def update_template_status(data):
@@ -421,20 +568,7 @@ def update_template_status(data):
 		WHERE id = %(message_template_id)s""",
         data,
     )
-
-def update_message_status(data):
-    """Update message status."""
-    id = data["statuses"][0]["id"]
-    status = data["statuses"][0]["status"]
-    conversation = data["statuses"][0].get("conversation", {}).get("id")
-    name = frappe.db.get_value("WhatsApp Message", filters={"message_id": id})
-
-    doc = frappe.get_doc("WhatsApp Message", name)
-    doc.status = status
-    if conversation:
-        doc.conversation_id = conversation
-    doc.save(ignore_permissions=True)
-
+    clear_template_cache()
 
 @frappe.whitelist(allow_guest=True)
 def send_response_to_meta():
@@ -443,38 +577,21 @@ def send_response_to_meta():
         frappe.log_error(_("Payload not found"))
         return
 
-    settings = frappe.get_doc("WhatsApp Settings", "WhatsApp Settings")
-    token = settings.get_password("token")
-
-    headers = {
-        "authorization": f"Bearer {token}",
-        "content-type": "application/json",
-    }
-
     try:
-        response = requests.post(
-            f"{settings.url}/{settings.version}/{settings.phone_id}/messages",
-            headers=headers,
-            data=json.dumps(payload),
-        )
-        
-        response.raise_for_status()
-        result = response.json()
+        result = get_client().send_message(payload)
         
         return result
 
-    except Exception as e:
-        res = frappe.flags.integration_request.json()["error"]
-        error_message = res.get("Error", res.get("message"))
+    except GraphAPIError as e:
         frappe.get_doc(
             {
                 "doctype": "WhatsApp Notification Log",
                 "template": "Text Message",
-                "meta_data": frappe.flags.integration_request.json(),
+                "meta_data": e.data,
             }
         ).insert(ignore_permissions=True)
 
-        frappe.throw(msg=error_message, title=res.get("error_user_title", "Error"))
+        frappe.throw(msg=e.message, title=e.title or "Error")
 
 
 class StockpileBalanceFilter(TypedDict):
@@ -540,6 +657,10 @@ def filter_text_message(text):
 
 @frappe.whitelist(allow_guest=True)
 def get_stockpile_balance_report(filters):
+    return get_cached_report("stockpile", filters, build_stockpile_balance_report)
+
+
+def build_stockpile_balance_report(filters):
     # filters = frappe._dict({"site_name": "Pusaka Tanah Persada", "year": "2024"})
     stockpile_balances = get_stockpile_balance(filters)
     data_map = {}
@@ -569,7 +690,10 @@ def get_production_data(filters):
 
 @frappe.whitelist(allow_guest=True)
 def get_yearly_production_data(filters):
+    return get_cached_report("production", filters, build_yearly_production_data)
+
 
+def build_yearly_production_data(filters):
     # filters = frappe._dict({"site_name": "PT Pusaka Tanah Persada", "year": "2025"})
 
     current_year_data = get_current_year_production_data(filters)
@@ -578,10 +702,9 @@ def get_yearly_production_data(filters):
         return []
 
     prod_data = {}
-    for i, i_items in current_year_data.items():
-        item = get_mining_item(i)
+    for i_items in current_year_data.values():
         prod_data.setdefault(
-            item.mining_item_name,
+            i_items["item_name"],
             {"tonnage": i_items["total_tonnage"], "uom": i_items["uom"]},
         )
 
@@ -598,64 +721,46 @@ def get_yearly_production_data(filters):
 
 
 def get_current_year_production_data(filters):
-    prod = frappe.qb.DocType("Site Daily Production Entry")
-    prod_detail = frappe.qb.DocType("Site Daily Production Entry Detail")
-
-    sum_tonnage = Sum(prod_detail.tonnage_by_tf).as_("tonnage_by_tf")
-
-    query = (
-        frappe.qb.select(
-            prod.site_name,
-            prod.source_pit,
-            Extract("month", prod.posting_date).as_("month"),
-            Extract("year", prod.posting_date).as_("year"),
-            prod_detail.mining_item_code,
-            prod_detail.mining_item_name,
-            sum_tonnage,
-            prod_detail.tonnage_by_tf_uom,
-        )
-        .from_(prod_detail)
-        .join(prod)
-        .on(prod.name == prod_detail.parent)
-        .where(
-            (prod.docstatus == 1)
-            & (prod.site_name == filters.get("site_name"))
-            & (Extract("year", prod.posting_date) == filters.get("year"))
-        )
-        .orderby(prod.posting_date)
-        .groupby(prod_detail.mining_item_code)
-        .groupby(Extract("month", prod.posting_date))
-    )
-
-    data = query.run(as_dict=True)
+    data = get_production_summary(filters.get("site_name"), filters.get("year"))
+    items = get_mining_items({d.mining_item_code for d in data if flt(d.tonnage, 3)})
 
     data_map = {}
     for d in data:
-        data_map.setdefault(d.mining_item_code, {}).setdefault("tonnage_by_month", {})
-        data_map[d.mining_item_code]["tonnage_by_month"][d.month] = d.tonnage_by_tf
-        for m in range(1, 13):
-            if m != d.month:
-                data_map.setdefault(d.mining_item_code, {}).setdefault(
-                    "tonnage_by_month", {}
-                ).setdefault(m, 0)
-
-    for j in data_map:
-        total_tonnage = 0
-
-        item = get_mining_item(j)
-        for k, val in data_map[j]["tonnage_by_month"].items():
-            total_tonnage += val
+        # months emptied by cancellations
+        if not flt(d.tonnage, 3):
+            continue
+
+        item_data = data_map.get(d.mining_item_code)
+        if not item_data:
+            item = items.get(d.mining_item_code) or frappe._dict()
+            item_data = data_map[d.mining_item_code] = {
+                "tonnage_by_month": dict.fromkeys(range(1, 13), 0),
+                "total_tonnage": 0,
+                "uom": item.mining_item_uom,
+                "item_name": item.mining_item_name or d.mining_item_code,
+            }
 
-        data_map.setdefault(j, {}).setdefault("total_tonnage", total_tonnage)
-        data_map.setdefault(j, {}).setdefault("uom", item.mining_item_uom)
+        item_data["tonnage_by_month"][d.month] = d.tonnage
+        item_data["total_tonnage"] += d.tonnage
 
     return data_map
 
 
 def get_last_production_datetime(filters):
+    p = get_last_production_query(filters).run(as_dict=True)
+    return p[0]
+
+
+def get_last_production_query(filters):
+    """Latest submitted entry of the site's year.
+
+    Filters and sorts on the bare columns so the (docstatus, site_name,
+    posting_date, posting_time) index answers it with a single seek.
+    """
     prod = frappe.qb.DocType("Site Daily Production Entry")
+    year = filters.get("year")
 
-    prod_query = (
+    return (
         frappe.qb.select(
             prod.name,
             prod.site_name,
@@ -666,15 +771,12 @@ def get_last_production_datetime(filters):
         .where(
             (prod.docstatus == 1)
             & (prod.site_name == filters.get("site_name"))
-            & (Extract("year", prod.posting_date) == filters.get("year"))
-        )
-        .orderby(
-            CombineDatetime(prod.posting_date, prod.posting_time), order=Order.desc
+            & (prod.posting_date.between(f"{year}-01-01", f"{year}-12-31"))
         )
+        .orderby(prod.posting_date, order=Order.desc)
+        .orderby(prod.posting_time, order=Order.desc)
         .limit(1)
     )
-    p = prod_query.run(as_dict=True)
-    return p[0]
 
 
 def get_combine_datetime(posting_date, posting_time):
@@ -692,18 +794,21 @@ def get_combine_datetime(posting_date, posting_time):
     return datetime.datetime.combine(posting_date, posting_time).replace(microsecond=0)
 
 
-def get_mining_item(item):
+def get_mining_items(items):
+    """Mining Items by name, fetched with one query."""
+    if not items:
+        return {}
+
     mining_item = frappe.qb.DocType("Mining Item")
     mining_query = (
         frappe.qb.from_(mining_item)
         .select(
             mining_item.name, mining_item.mining_item_name, mining_item.mining_item_uom
         )
-        .where(mining_item.name == item)
+        .where(mining_item.name.isin(list(items)))
     )
-    q = mining_query.run(as_dict=True)
 
-    return q[0]
+    return {d.name: d for d in mining_query.run(as_dict=True)}
 
 
 def get_site_name(item):